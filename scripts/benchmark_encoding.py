@@ -0,0 +1,88 @@
+from pathlib import Path
+import json
+import tempfile
+import time
+
+from level2_processing import ENCODING_PROFILES, netcdf_encoding
+
+
+def benchmark_file(filepath: Path, profiles: list[str] | None = None, repeats: int = 1) -> list[dict]:
+    """Measure the write time, read time and file size of a level2 file for each encoding profile.
+
+    Parameters
+    ----------
+    filepath
+        The level2 (.nc) file to benchmark.
+    profiles
+        Optional. The names of the profiles to benchmark. Defaults to all in ENCODING_PROFILES.
+    repeats
+        How many times to repeat each measurement. The fastest time is reported.
+
+    Returns
+    -------
+    One result per profile.
+    """
+    import xarray as xr
+
+    if profiles is None:
+        profiles = list(ENCODING_PROFILES)
+
+    data = xr.load_dataset(filepath)
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for profile in profiles:
+            output_filepath = Path(temp_dir) / f"{profile}.nc"
+            encoding = netcdf_encoding(data, profile)
+
+            write_times = []
+            read_times = []
+            for _ in range(repeats):
+                output_filepath.unlink(missing_ok=True)
+                start_time = time.perf_counter()
+                data.to_netcdf(output_filepath, encoding=encoding)
+                write_times.append(time.perf_counter() - start_time)
+
+                start_time = time.perf_counter()
+                xr.load_dataset(output_filepath).close()
+                read_times.append(time.perf_counter() - start_time)
+
+            results.append({
+                "file": str(filepath),
+                "profile": profile,
+                "write_s": min(write_times),
+                "read_s": min(read_times),
+                "size_mb": output_filepath.stat().st_size / 1e6,
+                "original_size_mb": filepath.stat().st_size / 1e6,
+            })
+
+    return results
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the netCDF encoding profiles on level2 files.")
+    parser.add_argument("filepaths", nargs="+", type=Path, help="Level2 .nc files or directories to search for them in.")
+    parser.add_argument("--profiles", nargs="+", choices=list(ENCODING_PROFILES), default=None)
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--json", type=Path, default=None, help="Optional. Save the results as JSON here.")
+    args = parser.parse_args()
+
+    filepaths = []
+    for filepath in args.filepaths:
+        filepaths += sorted(filepath.rglob("*.nc")) if filepath.is_dir() else [filepath]
+
+    results = []
+    print(f"{'file':<50} {'profile':<10} {'write [s]':>10} {'read [s]':>10} {'size [MB]':>10}")
+    for filepath in filepaths:
+        for result in benchmark_file(filepath, profiles=args.profiles, repeats=args.repeats):
+            print(f"{filepath.name:<50} {result['profile']:<10} {result['write_s']:>10.2f} {result['read_s']:>10.2f} {result['size_mb']:>10.1f}")
+            results.append(result)
+
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+from pathlib import Path
+from typing import Callable
+import datetime
+import gc
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import preprocess_mala
+import level2_processing
+
+# The default (traces, samples) sizes of the synthetic datasets
+DEFAULT_SIZES = [(1000, 512), (20000, 1024)]
+
+# The (traces, samples) size of a long survey line. It takes several GB of disk and memory, so it's opt-in (--large)
+LARGE_SIZE = (200000, 2048)
+
+# The fraction of synthetic traces that are left empty, for remove_empty_traces to find
+EMPTY_TRACE_FRACTION = 0.05
+
+
+def write_synthetic_ramac(rad_filepath: Path, n_traces: int, n_samples: int, seed: int = 0, chunk_size: int = preprocess_mala.CHUNK_TRACES):
+    """Write a synthetic Malå Ramac (.rad/.rd3/.cor) triplet.
+
+    The radargram is decaying noise in which a fraction of the traces (EMPTY_TRACE_FRACTION) are empty.
+    It is written in chunks, so the largest sizes never have to fit in memory.
+    """
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+
+    rad = {
+        "SAMPLES": n_samples,
+        "FREQUENCY": 1000.,
+        "FREQUENCY STEPS": 1,
+        "SIGNAL POSITION": 0,
+        "RAW SIGNAL POSITION": 0,
+        "DISTANCE FLAG": 0,
+        "TIME FLAG": 1,
+        "PROGRAM FLAG": 0,
+        "EXTERNAL FLAG": 0,
+        "TIME INTERVAL": 0.25,
+        "DISTANCE INTERVAL": 0.,
+        "OPERATOR": "",
+        "CUSTOMER": "",
+        "SITE": "synthetic",
+        "ANTENNAS": "100 MHz",
+        "ANTENNA ORIENTATION": "NOT VALID FIELD",
+        "ANTENNA SEPARATION": 1.,
+        "COMMENT": "",
+        "TIMEWINDOW": n_samples,
+        "STACKS": 1,
+        "STACK EXPONENT": 0,
+        "STACKING TIME": 0.,
+        "LAST TRACE": n_traces,
+        "STOP POSITION": 0.,
+    }
+    rad_filepath.write_text("\n".join(f"{key}: {value}" for key, value in rad.items()))
+
+    empty = rng.random(n_traces) < EMPTY_TRACE_FRACTION
+    envelope = (8000 * np.exp(-np.arange(n_samples) / (n_samples / 4)))[None, :]
+    with open(rad_filepath.with_suffix(".rd3"), "wb") as outfile:
+        for start in range(0, n_traces, chunk_size):
+            n = min(chunk_size, n_traces - start)
+            block = (rng.standard_normal((n, n_samples)) * envelope).astype("<i2")
+            block[empty[start:start + n]] = 0
+            block.tofile(outfile)
+
+    # One coordinate per ten traces, like a GPS logging slower than the radar
+    trace_numbers = np.arange(1, n_traces + 1, 10)
+    times = np.datetime64("2025-04-20T10:00:00", "ms") + (trace_numbers * rad["TIME INTERVAL"] * 1000).astype("timedelta64[ms]")
+    cor = pd.DataFrame({
+        0: trace_numbers,
+        1: np.datetime_as_string(times, unit="D"),
+        2: [str(t)[11:] for t in times],
+        3: 79.5 + trace_numbers * 1e-6,
+        4: "N",
+        5: 24. + trace_numbers * 1e-6,
+        6: "E",
+        7: 500. + np.sin(trace_numbers / 1000),
+        8: "M",
+        9: 1,
+    })
+    cor.to_csv(rad_filepath.with_suffix(".cor"), sep="\t", header=False, index=False)
+
+
+def write_synthetic_level2(filepath: Path, n_traces: int, n_samples: int, seed: int = 0, chunk_size: int = 8192):
+    """Write a synthetic level2-shaped (.nc) radargram.
+
+    The (y, x) "data" variable is decaying noise with low-frequency power undulations, for lowfreq_corr to find.
+    It is appended with netCDF4 in chunks, so the largest sizes never have to fit in memory.
+    """
+    import netCDF4
+    import xarray as xr
+
+    rng = np.random.default_rng(seed)
+
+    skeleton = xr.Dataset(
+        coords={"x": np.arange(n_traces, dtype="float64"), "y": np.arange(n_samples, dtype="float64")},
+        data_vars={"depth": ("y", np.linspace(0, 200, n_samples))},
+        attrs={"time-interval": 0.25, "power_fixed": 0},
+    )
+    skeleton.to_netcdf(filepath)
+
+    envelope = np.exp(-np.arange(n_samples) / (n_samples / 4))[:, None]
+    with netCDF4.Dataset(filepath, "a") as dataset:
+        out = dataset.createVariable("data", "float32", ("y", "x"), fill_value=np.nan)
+        for start in range(0, n_traces, chunk_size):
+            x = np.arange(start, min(start + chunk_size, n_traces))
+            undulation = 1 + 0.3 * np.sin(2 * np.pi * x / 2000)[None, :]
+            out[:, start:start + x.size] = (rng.standard_normal((n_samples, x.size)) * envelope * undulation).astype("float32")
+
+
+def measure(func: Callable[[], object], setup: Callable[[], None] | None = None, repeats: int = 1) -> dict:
+    """Measure the wall time and peak Python-allocated memory of a function.
+
+    The time is the fastest of the repeats. The memory is measured in one extra run with tracemalloc,
+    which numpy reports its array allocations to, so that its overhead doesn't affect the timing.
+    That run comes first, so it also takes any one-time costs like imports.
+
+    Parameters
+    ----------
+    func
+        The function to measure.
+    setup
+        Optional. A function to run (untimed) before every call.
+    repeats
+        How many times to repeat the timing.
+    """
+    peak = None
+    times = []
+    for _ in range(repeats + 1):
+        if setup is not None:
+            setup()
+        gc.collect()
+
+        if peak is None:
+            tracemalloc.start()
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            continue
+
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+
+    return {"time_s": min(times), "peak_mb": peak / 1e6}
+
+
+def benchmark_size(n_traces: int, n_samples: int, work_dir: Path, repeats: int = 1) -> list[dict]:
+    """Benchmark the processing functions on synthetic data of one size.
+
+    Parameters
+    ----------
+    n_traces
+        The number of traces of the synthetic data.
+    n_samples
+        The number of samples per trace of the synthetic data.
+    work_dir
+        The directory to write the synthetic data and outputs in.
+    repeats
+        How many times to repeat each measurement. The fastest time is reported.
+
+    Returns
+    -------
+    One result per benchmarked function.
+    """
+    rad_filepath = work_dir / "synthetic.rad"
+    level2_filepath = work_dir / "synthetic.nc"
+    output_rad_filepath = work_dir / "output" / "synthetic.rad"
+    output_rad_filepath.parent.mkdir(exist_ok=True)
+
+    write_synthetic_ramac(rad_filepath, n_traces, n_samples)
+    write_synthetic_level2(level2_filepath, n_traces, n_samples)
+
+    results = {
+        "load_ramac": measure(lambda: preprocess_mala.load_ramac(rad_filepath), repeats=repeats),
+        "load_ramac[mmap]": measure(lambda: preprocess_mala.load_ramac(rad_filepath, mmap=True), repeats=repeats),
+        # The first (untimed) call fills the cache
+        "load_ramac[cached cor]": measure(lambda: preprocess_mala.load_ramac(rad_filepath, mmap=True, cor_cache_dir=work_dir / preprocess_mala.COR_CACHE_DIR), repeats=repeats),
+    }
+    gpr = preprocess_mala.load_ramac(rad_filepath)
+    results["remove_empty_traces"] = measure(lambda gpr=gpr: preprocess_mala.remove_empty_traces(gpr), repeats=repeats)
+    # The memory-bounded removal that preprocess_mala uses
+    results["stream_remove_empty_traces"] = measure(
+        lambda gpr=gpr: preprocess_mala.stream_remove_empty_traces(output_rad_filepath, rad_filepath.with_suffix(".rd3"), gpr.rad, gpr.cor),
+        repeats=repeats,
+    )
+    gpr = preprocess_mala.remove_empty_traces(gpr)
+    results["save_ramac"] = measure(lambda gpr=gpr: preprocess_mala.save_ramac(output_rad_filepath, gpr), repeats=repeats)
+    del gpr
+
+    import xarray as xr
+
+    with xr.open_dataset(level2_filepath) as data:
+        fs = 1 / data.attrs["time-interval"]
+        line = np.abs(data["data"].isel(y=slice(n_samples - 10, None))).mean("y").values
+        edges = np.linspace(0, n_samples, 5).astype(int)
+        lines = np.stack([np.abs(data["data"].isel(y=slice(start, end))).mean("y").values for start, end in zip(edges[:-1], edges[1:])])
+        values = data["data"].values
+
+    results["lowfreq_corr"] = measure(lambda: level2_processing.lowfreq_corr(line, fs), repeats=repeats)
+    results["lowfreq_corr[4 bands]"] = measure(lambda: level2_processing.lowfreq_corr(lines, fs), repeats=repeats)
+    results["normalize"] = measure(lambda values=values: level2_processing.normalize(values), repeats=repeats)
+    int_values = np.clip(values * 1000, -32767, 32767).astype("int16")
+    results["normalize[int16]"] = measure(lambda int_values=int_values: level2_processing.normalize(int_values), repeats=repeats)
+    del values, int_values
+
+    results["generate_jpgs"] = measure(lambda: level2_processing.generate_jpgs(level2_filepath, redo=True), repeats=repeats)
+    results["generate_jpgs[streaming]"] = measure(lambda: level2_processing.generate_jpgs(level2_filepath, redo=True, streaming=True), repeats=repeats)
+
+    return [{"benchmark": name, "n_traces": n_traces, "n_samples": n_samples} | result for name, result in results.items()]
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes: list[tuple[int, int]] = DEFAULT_SIZES, repeats: int = 1, work_dir: Path | None = None) -> dict:
+    """Run the benchmarks on synthetic data of every size.
+
+    Parameters
+    ----------
+    sizes
+        The (traces, samples) sizes to benchmark.
+    repeats
+        How many times to repeat each measurement. The fastest time is reported.
+    work_dir
+        Optional. The directory to write the synthetic data in. Defaults to a temporary directory.
+
+    Returns
+    -------
+    The results and a description of the environment they were measured in.
+    """
+    report = {
+        "commit": _git_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpu_count": os.cpu_count(),
+        "results": [],
+    }
+    for n_traces, n_samples in sizes:
+        with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
+            report["results"] += benchmark_size(n_traces, n_samples, Path(temp_dir), repeats=repeats)
+
+    return report
+
+
+def compare(report: dict, baseline: dict) -> list[dict]:
+    """Compare the results of two benchmark reports.
+
+    Returns
+    -------
+    The time and memory ratios (report / baseline) of every benchmark and size that exist in both.
+    """
+    baseline_results = {(r["benchmark"], r["n_traces"], r["n_samples"]): r for r in baseline["results"]}
+
+    comparison = []
+    for result in report["results"]:
+        key = (result["benchmark"], result["n_traces"], result["n_samples"])
+        if key not in baseline_results:
+            continue
+        base = baseline_results[key]
+        comparison.append({
+            "benchmark": result["benchmark"],
+            "n_traces": result["n_traces"],
+            "n_samples": result["n_samples"],
+            "time_ratio": result["time_s"] / base["time_s"] if base["time_s"] > 0 else np.nan,
+            "peak_ratio": result["peak_mb"] / base["peak_mb"] if base["peak_mb"] > 0 else np.nan,
+        })
+    return comparison
+
+
+def _parse_size(size: str) -> tuple[int, int]:
+    n_traces, n_samples = size.lower().split("x")
+    return int(n_traces), int(n_samples)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the processing functions on synthetic Ramac and level2 data.")
+    parser.add_argument("--sizes", nargs="+", type=_parse_size, default=DEFAULT_SIZES, help="Sizes as TRACESxSAMPLES, e.g. 200000x2048.")
+    parser.add_argument("--large", action="store_true", help=f"Also benchmark the size of a long survey line ({LARGE_SIZE[0]}x{LARGE_SIZE[1]}).")
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--work-dir", type=Path, default=None, help="Optional. Where to write the synthetic data.")
+    parser.add_argument("--json", type=Path, default=None, help="Optional. Save the results as JSON here.")
+    parser.add_argument("--compare", type=Path, default=None, help="Optional. A previous JSON report to compare with.")
+    args = parser.parse_args()
+
+    sizes = args.sizes + ([LARGE_SIZE] if args.large and LARGE_SIZE not in args.sizes else [])
+    report = run_benchmarks(sizes, repeats=args.repeats, work_dir=args.work_dir)
+
+    print(f"{'benchmark':<26} {'traces':>8} {'samples':>8} {'time [s]':>10} {'peak [MB]':>10}")
+    for result in report["results"]:
+        print(f"{result['benchmark']:<26} {result['n_traces']:>8} {result['n_samples']:>8} {result['time_s']:>10.3f} {result['peak_mb']:>10.1f}")
+
+    if args.json is not None:
+        args.json.write_text(json.dumps(report, indent=1))
+
+    if args.compare is not None:
+        baseline = json.loads(args.compare.read_text())
+        print(f"\nCompared with {baseline.get('commit')}:")
+        print(f"{'benchmark':<26} {'traces':>8} {'samples':>8} {'time':>8} {'peak':>8}")
+        for result in compare(report, baseline):
+            print(f"{result['benchmark']:<26} {result['n_traces']:>8} {result['n_samples']:>8} {result['time_ratio']:>7.2f}x {result['peak_ratio']:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
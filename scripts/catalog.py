@@ -0,0 +1,341 @@
+from pathlib import Path
+import contextlib
+import datetime
+import json
+import re
+import sqlite3
+import warnings
+import numpy as np
+import pandas as pd
+
+from level2_processing import OUTPUT_FORMATS, input_filepaths, open_level2
+from preprocess_mala import COR_CACHE_DIR, TIME_EPOCH
+
+# The default location of the catalog database
+CATALOG_FILEPATH = Path("processed/catalog.sqlite")
+
+# The parts of the naming convention of radar keys, e.g. "austfonna-profile-2025-100MHz-mala-01"
+KEY_PARTS = ["site", "survey", "year", "frequency", "instrument", "line"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS profiles (
+    radar_key TEXT PRIMARY KEY,
+    site TEXT,
+    survey TEXT,
+    year INTEGER,
+    frequency_mhz REAL,
+    instrument TEXT,
+    line TEXT,
+    level1_filepath TEXT,
+    level1_size INTEGER,
+    level1_fingerprint TEXT,
+    header TEXT,
+    n_traces INTEGER,
+    n_samples INTEGER,
+    time_start REAL,
+    time_end REAL,
+    lon_min REAL,
+    lon_max REAL,
+    lat_min REAL,
+    lat_max REAL,
+    level2_filepath TEXT,
+    level2_size INTEGER,
+    level2_fingerprint TEXT,
+    processed INTEGER,
+    power_fixed INTEGER,
+    in_manifest INTEGER,
+    updated TEXT
+);
+CREATE INDEX IF NOT EXISTS profiles_site_frequency ON profiles (site, frequency_mhz);
+CREATE INDEX IF NOT EXISTS profiles_year ON profiles (year);
+CREATE INDEX IF NOT EXISTS profiles_bbox ON profiles (lon_min, lon_max, lat_min, lat_max);
+"""
+
+
+def parse_radar_key(radar_key: str) -> dict | None:
+    """Parse a radar key into its parts (see KEY_PARTS), or None if it doesn't follow the naming convention."""
+    parts = radar_key.split("-")
+    if len(parts) != len(KEY_PARTS):
+        return None
+
+    parsed = dict(zip(KEY_PARTS, parts))
+    try:
+        parsed["year"] = int(parsed["year"])
+        parsed["frequency_mhz"] = float(parsed.pop("frequency").removesuffix("MHz"))
+    except ValueError:
+        return None
+    return parsed
+
+
+def _fingerprint(filepaths: list[Path]) -> str:
+    """Summarize the names, sizes and modification times of files, to know when they change."""
+    return json.dumps([[filepath.name, (stat := filepath.stat()).st_size, stat.st_mtime_ns] for filepath in filepaths])
+
+
+def _find_level2(level2_stem: Path) -> Path | None:
+    """Find the level2 data (in any of the OUTPUT_FORMATS) of a profile, or None if it's not processed."""
+    for suffix in OUTPUT_FORMATS.values():
+        if (level2_filepath := level2_stem.with_suffix(suffix)).exists():
+            return level2_filepath
+    return None
+
+
+def _level2_files(level2_filepath: Path) -> list[Path]:
+    """Get the files of level2 data. A Zarr store is a directory of files."""
+    if level2_filepath.is_dir():
+        return sorted(filepath for filepath in level2_filepath.rglob("*") if filepath.is_file())
+    return [level2_filepath]
+
+
+def _gga_fields(gp2: pd.DataFrame) -> pd.DataFrame | None:
+    """Split the NMEA GGA sentences in a pulseEKKO GPS table into their fields, or None if there are none."""
+    for column in gp2.columns[1:]:
+        sentences = gp2[column].astype(str)
+        gga = sentences[sentences.str.contains("GGA,", regex=False)]
+        if gga.shape[0] > 0:
+            return gga.str.split(",", expand=True)
+    return None
+
+
+def _gga_positions(gp2: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    """Parse the longitudes and latitudes of the NMEA GGA sentences in a pulseEKKO GPS table."""
+    if (fields := _gga_fields(gp2)) is None:
+        return np.empty(0), np.empty(0)
+
+    # Latitudes and longitudes are given as (d)ddmm.mmmm with a hemisphere letter
+    lat = pd.to_numeric(fields[2], errors="coerce")
+    lon = pd.to_numeric(fields[4], errors="coerce")
+    lats = ((lat // 100) + (lat % 100) / 60) * np.where(fields[3] == "S", -1, 1)
+    lons = ((lon // 100) + (lon % 100) / 60) * np.where(fields[5] == "W", -1, 1)
+    return np.asarray(lons, dtype="float64"), np.asarray(lats, dtype="float64")
+
+
+def _header_date(hd: dict[str, str | None]) -> np.datetime64 | None:
+    """Find the survey date among the lines of a pulseEKKO .hd header without a value (see pulseekko.read_hd)."""
+    for line, value in hd.items():
+        # The file tag is also a line without a value, but it has no date separators
+        if value is not None or not re.fullmatch(r"\w+[-/.]\w+[-/.]\w+", line):
+            continue
+        if not pd.isna(date := pd.to_datetime(line, errors="coerce", format="mixed", dayfirst=True)):
+            return np.datetime64(date.date(), "s")
+    return None
+
+
+def _gga_times(gp2: pd.DataFrame, date: np.datetime64) -> np.ndarray:
+    """Get the times of the NMEA GGA sentences in a pulseEKKO GPS table, in seconds since TIME_EPOCH.
+
+    The sentences only have the UTC time of day (hhmmss.ss), so the date is taken from the header.
+    A time of day that is more than 12 hours earlier than the one before means that midnight passed.
+    """
+    if (fields := _gga_fields(gp2)) is None:
+        return np.empty(0)
+
+    hhmmss = pd.to_numeric(fields[1], errors="coerce").to_numpy(dtype="float64")
+    seconds = (hhmmss // 10000) * 3600 + ((hhmmss // 100) % 100) * 60 + hhmmss % 100
+    days = np.cumsum(np.r_[0, np.diff(seconds) < -12 * 3600])
+    return (date - TIME_EPOCH).astype("float64") + days * 86400 + seconds
+
+
+def read_level1_summary(header_filepath: Path, cor_cache_dir: Path | None = None) -> dict:
+    """Read the header fields, size, time span and bounding box of a level1 radargram.
+
+    Ramac corfiles are cached in the optional cor_cache_dir (see preprocess_mala.read_cor).
+    """
+    if header_filepath.suffix == ".rad":
+        from preprocess_mala import load_ramac
+        gpr = load_ramac(header_filepath, mmap=True, cor_cache_dir=cor_cache_dir)
+        lons, lats = gpr.cor[5].to_numpy(dtype="float64"), gpr.cor[3].to_numpy(dtype="float64")
+        times = gpr.cor["time"].to_numpy(dtype="float64")
+    else:
+        from pulseekko import load_pulseekko
+        gpr = load_pulseekko(header_filepath, mmap=True)
+        lons, lats = _gga_positions(gpr.cor)
+        # The gp2 time column is the time elapsed since the start, so the GGA times are used
+        times = np.empty(0)
+        if (date := _header_date(gpr.rad)) is not None:
+            times = _gga_times(gpr.cor, date)
+
+    def span(values: np.ndarray) -> tuple[float | None, float | None]:
+        values = values[np.isfinite(values)]
+        return (float(values.min()), float(values.max())) if values.size > 0 else (None, None)
+
+    time_start, time_end = span(times)
+    lon_min, lon_max = span(lons)
+    lat_min, lat_max = span(lats)
+
+    return {
+        "header": json.dumps(gpr.rad),
+        "n_traces": gpr.n_traces,
+        "n_samples": gpr.rd3.shape[0],
+        "time_start": time_start,
+        "time_end": time_end,
+        "lon_min": lon_min,
+        "lon_max": lon_max,
+        "lat_min": lat_min,
+        "lat_max": lat_max,
+    }
+
+
+def read_level2_summary(processed_filepath: Path) -> dict:
+    """Read the processing state of a level2 radargram."""
+    with open_level2(processed_filepath) as data:
+        return {"processed": 1, "power_fixed": int(data.attrs.get("power_fixed", 0))}
+
+
+def update_catalog(
+    catalog_filepath: Path = CATALOG_FILEPATH,
+    level1_dir: Path = Path("processed/level1"),
+    level2_dir: Path = Path("processed/level2"),
+) -> int:
+    """Scan the level1 and level2 directories and update the catalog with one row per profile.
+
+    The update is incremental: headers are only re-read for profiles whose files changed
+    (by size or modification time), and rows of profiles that no longer exist are removed.
+
+    Parameters
+    ----------
+    catalog_filepath
+        The filepath of the SQLite catalog. It is created if it doesn't exist.
+    level1_dir
+        The level1 directory to scan.
+    level2_dir
+        The level2 directory to scan.
+
+    Returns
+    -------
+    The number of added or updated rows.
+    """
+    catalog_filepath.parent.mkdir(exist_ok=True, parents=True)
+
+    manifest_filepath = level2_dir / "manifest.json"
+    manifest_products = json.loads(manifest_filepath.read_text())["products"] if manifest_filepath.is_file() else {}
+
+    n_updated = 0
+    with contextlib.closing(sqlite3.connect(catalog_filepath)) as connection, connection:
+        connection.executescript(SCHEMA)
+        existing = {
+            row[0]: (row[1], row[2], row[3])
+            for row in connection.execute("SELECT radar_key, level1_fingerprint, level2_fingerprint, in_manifest FROM profiles")
+        }
+
+        seen = set()
+        for header_filepath in sorted(level1_dir.rglob("*.*")):
+            if header_filepath.suffix not in [".hd", ".rad"]:
+                continue
+            radar_key = header_filepath.stem
+            if (key_parts := parse_radar_key(radar_key)) is None:
+                print(f"Found {header_filepath} but its name was unexpected")
+                continue
+            seen.add(radar_key)
+
+            level2_filepath = _find_level2(level2_dir / header_filepath.relative_to(level1_dir))
+            level2_filepaths = _level2_files(level2_filepath) if level2_filepath is not None else []
+            level1_filepaths = input_filepaths(header_filepath)
+            level1_fingerprint = _fingerprint(level1_filepaths)
+            level2_fingerprint = _fingerprint(level2_filepaths) if level2_filepath is not None else None
+            in_manifest = int(level2_filepath is not None and level2_filepath.relative_to(level2_dir).as_posix() in manifest_products)
+
+            if existing.get(radar_key) == (level1_fingerprint, level2_fingerprint, in_manifest):
+                continue
+
+            row = {
+                "radar_key": radar_key,
+                "site": key_parts["site"],
+                "survey": key_parts["survey"],
+                "year": key_parts["year"],
+                "frequency_mhz": key_parts["frequency_mhz"],
+                "instrument": key_parts["instrument"],
+                "line": key_parts["line"],
+                "level1_filepath": str(header_filepath),
+                "level1_size": sum(filepath.stat().st_size for filepath in level1_filepaths),
+                "level1_fingerprint": level1_fingerprint,
+                "level2_filepath": str(level2_filepath) if level2_fingerprint is not None else None,
+                "level2_size": sum(filepath.stat().st_size for filepath in level2_filepaths) if level2_fingerprint is not None else None,
+                "level2_fingerprint": level2_fingerprint,
+                "processed": 0,
+                "power_fixed": 0,
+                "in_manifest": in_manifest,
+                "updated": datetime.datetime.now().isoformat(timespec="seconds"),
+            }
+
+            try:
+                # The level1 summary is only reread if the level1 files changed
+                if radar_key in existing and existing[radar_key][0] == level1_fingerprint:
+                    columns = ["header", "n_traces", "n_samples", "time_start", "time_end", "lon_min", "lon_max", "lat_min", "lat_max"]
+                    values = connection.execute(f"SELECT {', '.join(columns)} FROM profiles WHERE radar_key = ?", (radar_key,)).fetchone()
+                    row |= dict(zip(columns, values))
+                else:
+                    row |= read_level1_summary(header_filepath, cor_cache_dir=level1_dir.parent / COR_CACHE_DIR)
+                if level2_fingerprint is not None:
+                    row |= read_level2_summary(level2_filepath)
+            except Exception as exception:
+                # The profile is still cataloged (so it's still processed), but without the summary
+                warnings.warn(f"Could not read {radar_key} for the catalog: {exception}")
+
+            connection.execute(
+                f"INSERT OR REPLACE INTO profiles ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                list(row.values()),
+            )
+            n_updated += 1
+
+        removed = set(existing) - seen
+        connection.executemany("DELETE FROM profiles WHERE radar_key = ?", [(radar_key,) for radar_key in removed])
+
+    return n_updated
+
+
+def find_profiles(
+    catalog_filepath: Path = CATALOG_FILEPATH,
+    site: str | None = None,
+    year: int | None = None,
+    frequency_mhz: float | None = None,
+    instrument: str | None = None,
+    bbox: tuple[float, float, float, float] | None = None,
+    processed: bool | None = None,
+) -> pd.DataFrame:
+    """Find profiles in the catalog.
+
+    Parameters
+    ----------
+    catalog_filepath
+        The filepath of the SQLite catalog (see update_catalog).
+    site
+        Optional. Only profiles from this site, e.g. "austfonna".
+    year
+        Optional. Only profiles from this year.
+    frequency_mhz
+        Optional. Only profiles with this antenna frequency in MHz.
+    instrument
+        Optional. Only profiles with this instrument, e.g. "mala" or "pulseekko".
+    bbox
+        Optional. Only profiles that intersect this (lon_min, lat_min, lon_max, lat_max) box.
+    processed
+        Optional. Only profiles with (True) or without (False) level2 data.
+
+    Returns
+    -------
+    One row per profile.
+    """
+    conditions = []
+    parameters = []
+    for column, value in [("site", site), ("year", year), ("frequency_mhz", frequency_mhz), ("instrument", instrument)]:
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            parameters.append(value)
+    if bbox is not None:
+        conditions.append("lon_max >= ? AND lon_min <= ? AND lat_max >= ? AND lat_min <= ?")
+        parameters += [bbox[0], bbox[2], bbox[1], bbox[3]]
+    if processed is not None:
+        conditions.append("processed = ?")
+        parameters.append(int(processed))
+
+    query = "SELECT * FROM profiles"
+    if len(conditions) > 0:
+        query += " WHERE " + " AND ".join(conditions)
+
+    with contextlib.closing(sqlite3.connect(catalog_filepath)) as connection:
+        return pd.read_sql_query(query + " ORDER BY radar_key", connection, params=parameters)
+
+
+if __name__ == "__main__":
+    print(f"Updated {update_catalog()} profiles in {CATALOG_FILEPATH}")
@@ -0,0 +1,346 @@
+from pathlib import Path
+from typing import Callable
+import contextlib
+import datetime
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+
+# The environment variable with the filepath of the current run report.
+# It's an environment variable so that worker processes inherit it.
+RUN_REPORT_VARIABLE = "GPR_RUN_REPORT"
+
+# Whether the peak RSS can be reset per stage (Linux only). Checked on the first stage.
+_CAN_RESET_PEAK: bool | None = None
+
+# The records of the stages that are currently running in this process, innermost last
+_running: list[dict] = []
+
+# The (CPU time, bytes read, bytes written) of the finished background stages (see background_stage),
+# and the counters at the start of the running ones per thread id
+_background_done = [0., 0, 0]
+_background_running: dict[int, tuple[float, int, int]] = {}
+_background_lock = threading.Lock()
+
+
+def _io_counters() -> tuple[int, int] | None:
+    """Get the number of bytes read and written by this process (and its finished children) so far."""
+    try:
+        import psutil
+        counters = psutil.Process().io_counters()
+        # read_chars/write_chars (Linux) include reads that are served from the page cache
+        return getattr(counters, "read_chars", counters.read_bytes), getattr(counters, "write_chars", counters.write_bytes)
+    except (ImportError, AttributeError, OSError):
+        pass
+
+    try:
+        values = dict(line.split(":") for line in Path("/proc/self/io").read_text().splitlines())
+        return int(values["rchar"]), int(values["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _cpu_time() -> float:
+    """Get the CPU time in s used by this process and its finished children so far."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _thread_counters(native_id: int) -> tuple[float, int, int] | None:
+    """Get the CPU time in s and bytes read and written so far by one thread of this process. Only possible on Linux."""
+    try:
+        io = dict(line.split(":") for line in Path(f"/proc/self/task/{native_id}/io").read_text().splitlines())
+        # utime and stime are the 14th and 15th fields, counted after the (possibly spaced) command name
+        fields = Path(f"/proc/self/task/{native_id}/stat").read_text().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        return cpu, int(io["rchar"]), int(io["wchar"])
+    except (OSError, KeyError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def _background_total() -> tuple[float, int, int] | None:
+    """Get the CPU time and bytes read and written by all background stages so far, including the running ones."""
+    with _background_lock:
+        total = list(_background_done)
+        for native_id, start in _background_running.items():
+            if (current := _thread_counters(native_id)) is None:
+                return None
+            total = [value + now - before for value, now, before in zip(total, current, start)]
+    return tuple(total)
+
+
+def _reset_peak_rss() -> bool:
+    """Reset the peak RSS of the process to its current RSS. Only possible on Linux."""
+    global _CAN_RESET_PEAK
+    if _CAN_RESET_PEAK is False:
+        return False
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+        _CAN_RESET_PEAK = True
+    except OSError:
+        _CAN_RESET_PEAK = False
+    return _CAN_RESET_PEAK
+
+
+def _peak_rss() -> int | None:
+    """Get the peak RSS in bytes of this process since the last reset (or since the start)."""
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        import resource
+        # ru_maxrss is in bytes on macOS and in kB elsewhere
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    except ImportError:
+        pass
+
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+    except (ImportError, AttributeError):
+        return None
+
+
+def _write_record(report_filepath: Path, record: dict):
+    # One write per line, so that records from parallel workers don't get interleaved
+    with open(report_filepath, "a", encoding="utf-8") as outfile:
+        outfile.write(json.dumps(record) + "\n")
+
+
+@contextlib.contextmanager
+def stage(name: str, filepath: Path | str | None = None):
+    """Record the wall time, CPU time, peak RSS and bytes read and written of a processing stage.
+
+    The record is appended to the current run report (see run_report). If no report is active, nothing is recorded.
+
+    Stages may be nested. The peak RSS of the stage is then the peak over all of its inner stages too.
+    If the peak RSS cannot be reset per stage (outside of Linux), it is the peak of the process so far.
+
+    The CPU time and I/O counters are those of the whole process, except that the work of background stages
+    in other threads (see background_stage) is subtracted, so it's not billed to this stage. On Linux only.
+
+    Parameters
+    ----------
+    name
+        The name of the stage.
+    filepath
+        Optional. The file that the stage concerns.
+    """
+    report_filepath = os.environ.get(RUN_REPORT_VARIABLE)
+    if report_filepath is None:
+        yield
+        return
+
+    # Resetting the peak RSS would hide the peak of the outer stage, so it's saved first
+    if len(_running) > 0:
+        _running[-1]["peak"] = max(_running[-1]["peak"] or 0, _peak_rss() or 0)
+    _reset_peak_rss()
+
+    record = {"peak": None}
+    _running.append(record)
+    io_before = _io_counters()
+    cpu_before = _cpu_time()
+    background_before = _background_total()
+    start = datetime.datetime.now()
+    start_time = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as exception:
+        error = repr(exception)
+        raise
+    finally:
+        wall = time.perf_counter() - start_time
+        cpu = _cpu_time() - cpu_before
+        io_after = _io_counters()
+        background_after = _background_total()
+        if background_before is not None and background_after is not None:
+            background = [after - before for after, before in zip(background_after, background_before)]
+            cpu -= background[0]
+            if io_before is not None:
+                io_after = (io_after[0] - background[1], io_after[1] - background[2])
+        _running.pop()
+        peak = max(record["peak"] or 0, _peak_rss() or 0) or None
+        if len(_running) > 0:
+            _running[-1]["peak"] = max(_running[-1]["peak"] or 0, peak or 0)
+
+        _write_record(Path(report_filepath), {
+            "stage": name,
+            "file": str(filepath) if filepath is not None else None,
+            "start": start.isoformat(timespec="seconds"),
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "peak_rss_mb": peak / 1e6 if peak is not None else None,
+            "read_mb": (io_after[0] - io_before[0]) / 1e6 if io_before is not None else None,
+            "written_mb": (io_after[1] - io_before[1]) / 1e6 if io_before is not None else None,
+            "pid": os.getpid(),
+            "error": error,
+        })
+
+
+@contextlib.contextmanager
+def background_stage(name: str, filepath: Path | str | None = None):
+    """Record a stage that runs in a background thread, at the same time as stages in other threads.
+
+    The CPU time and bytes read and written are those of this thread only, and they are subtracted from the
+    stages that run in other threads at the same time (see stage). The peak RSS is not recorded, since it's
+    shared by the whole process. Outside of Linux, only the wall and CPU time are recorded.
+
+    Parameters
+    ----------
+    name
+        The name of the stage.
+    filepath
+        Optional. The file that the stage concerns.
+    """
+    report_filepath = os.environ.get(RUN_REPORT_VARIABLE)
+    if report_filepath is None:
+        yield
+        return
+
+    native_id = threading.get_native_id()
+    counters_before = _thread_counters(native_id)
+    cpu_before = time.thread_time()
+    if counters_before is not None:
+        with _background_lock:
+            _background_running[native_id] = counters_before
+
+    start = datetime.datetime.now()
+    start_time = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as exception:
+        error = repr(exception)
+        raise
+    finally:
+        wall = time.perf_counter() - start_time
+        cpu = time.thread_time() - cpu_before
+        io = None
+        if counters_before is not None:
+            with _background_lock:
+                del _background_running[native_id]
+                counters_after = _thread_counters(native_id)
+                if counters_after is None:
+                    # Keep the totals consistent with the last counters that the other stages saw
+                    counters_after = counters_before
+                delta = [after - before for after, before in zip(counters_after, counters_before)]
+                _background_done[:] = [value + change for value, change in zip(_background_done, delta)]
+            io = delta[1:]
+
+        _write_record(Path(report_filepath), {
+            "stage": name,
+            "file": str(filepath) if filepath is not None else None,
+            "start": start.isoformat(timespec="seconds"),
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "peak_rss_mb": None,
+            "read_mb": io[0] / 1e6 if io is not None else None,
+            "written_mb": io[1] / 1e6 if io is not None else None,
+            "pid": os.getpid(),
+            "error": error,
+        })
+
+
+def instrumented(file_argument: str | None = None) -> Callable:
+    """Decorate a function to record it as a stage (see stage), named after the function.
+
+    Parameters
+    ----------
+    file_argument
+        Optional. The name of the argument with the filepath that the stage concerns.
+    """
+    def decorator(func: Callable) -> Callable:
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if os.environ.get(RUN_REPORT_VARIABLE) is None:
+                return func(*args, **kwargs)
+
+            filepath = None
+            if file_argument is not None:
+                filepath = signature.bind(*args, **kwargs).arguments.get(file_argument)
+            with stage(func.__name__, filepath):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def load_run_report(report_filepath: Path) -> list[dict]:
+    """Load the records of a run report."""
+    return [json.loads(line) for line in report_filepath.read_text(encoding="utf-8").splitlines() if line.strip()]
+
+
+def summarize(records: list[dict]) -> list[dict]:
+    """Summarize stage records per stage.
+
+    Returns
+    -------
+    The number of calls and failures, total wall and CPU time, maximum peak RSS and total bytes read/written of each stage.
+    """
+    summary = {}
+    for record in records:
+        stats = summary.setdefault(record["stage"], {"stage": record["stage"], "calls": 0, "errors": 0, "wall_s": 0., "cpu_s": 0., "peak_rss_mb": 0., "read_mb": 0., "written_mb": 0.})
+        stats["calls"] += 1
+        stats["errors"] += record["error"] is not None
+        stats["wall_s"] += record["wall_s"]
+        stats["cpu_s"] += record["cpu_s"]
+        stats["peak_rss_mb"] = max(stats["peak_rss_mb"], record["peak_rss_mb"] or 0.)
+        stats["read_mb"] += record["read_mb"] or 0.
+        stats["written_mb"] += record["written_mb"] or 0.
+
+    return list(summary.values())
+
+
+def print_summary(report_filepath: Path):
+    """Print a table of the time, memory and I/O spent in each stage of a run report."""
+    if not report_filepath.is_file():
+        return
+
+    print(f"\nRun report: {report_filepath}")
+    print(f"{'stage':<22} {'calls':>6} {'errors':>6} {'wall [s]':>10} {'cpu [s]':>10} {'peak RSS [MB]':>14} {'read [MB]':>10} {'written [MB]':>12}")
+    for stats in summarize(load_run_report(report_filepath)):
+        print(
+            f"{stats['stage']:<22} {stats['calls']:>6} {stats['errors']:>6} {stats['wall_s']:>10.1f} {stats['cpu_s']:>10.1f}"
+            f" {stats['peak_rss_mb']:>14.0f} {stats['read_mb']:>10.0f} {stats['written_mb']:>12.0f}"
+        )
+
+
+@contextlib.contextmanager
+def run_report(report_filepath: Path):
+    """Record all stages (in this process and in worker processes started within) to a JSON-lines run report.
+
+    A summary table is printed when the run ends.
+
+    Parameters
+    ----------
+    report_filepath
+        The filepath of the report. Records are appended if it already exists.
+    """
+    report_filepath.parent.mkdir(exist_ok=True, parents=True)
+    previous = os.environ.get(RUN_REPORT_VARIABLE)
+    os.environ[RUN_REPORT_VARIABLE] = str(report_filepath.absolute())
+    try:
+        yield report_filepath
+    finally:
+        if previous is None:
+            del os.environ[RUN_REPORT_VARIABLE]
+        else:
+            os.environ[RUN_REPORT_VARIABLE] = previous
+        print_summary(report_filepath)
+
+
+def report_filepath(reports_dir: Path, name: str) -> Path:
+    """Get a new timestamped run report filepath, e.g. {reports_dir}/{name}-20250101T120000.jsonl."""
+    return reports_dir / f"{name}-{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}.jsonl"
@@ -1,16 +1,145 @@
 from pathlib import Path
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
 import shutil
-from preprocess_mala import preprocess_mala
+import tempfile
+import threading
+from preprocess_mala import COR_CACHE_DIR, preprocess_mala
+from pulseekko import preprocess_pulseekko
+from instrumentation import background_stage, run_report, report_filepath
+
+# The number of level0 lines to read ahead of the one that is being preprocessed
+PREFETCH_LINES = 2
+
+# The file states (see _file_state) computed in this run, so that files shared by
+# several lines (like GPS tracks) are only hashed once. Each path has its own lock.
+_file_states: dict[str, dict] = {}
+_file_state_locks: dict[str, threading.Lock] = {}
+_file_state_locks_lock = threading.Lock()
+
+
+def _reflink(input_filepath: Path, output_filepath: Path):
+    """Make a copy-on-write clone of a file. Raises OSError if unsupported (only Linux is supported)."""
+    try:
+        import fcntl
+    except ImportError as exception:
+        raise OSError("Reflinks are not supported on this platform") from exception
+
+    # The FICLONE ioctl request code from linux/fs.h
+    ficlone = 0x40049409
+    with open(input_filepath, "rb") as infile, open(output_filepath, "wb") as outfile:
+        fcntl.ioctl(outfile.fileno(), ficlone, infile.fileno())
+
 
 def copy_file(output_filepath: Path, input_filepath: Path):
+    """Place a file in a new location without duplicating its data if possible.
+
+    A hardlink is tried first, then a reflink, and lastly a regular copy.
+    The file is first placed under a temporary name beside the output and then moved in place,
+    so an interrupted copy never leaves a partial file behind or removes the previous one.
+    """
     output_filepath.parent.mkdir(exist_ok=True, parents=True)
-    if output_filepath.is_file():
-        return
-    
-    print(f"Copying {input_filepath} to {output_filepath}")
-    shutil.copy(input_filepath, output_filepath)
+    tmp_path = output_filepath.with_name(output_filepath.name + ".tmp")
+    tmp_path.unlink(missing_ok=True)
+
+    try:
+        os.link(input_filepath, tmp_path)
+        print(f"Linking {input_filepath} to {output_filepath}")
+    except OSError:
+        try:
+            _reflink(input_filepath, tmp_path)
+            print(f"Cloning {input_filepath} to {output_filepath}")
+        except OSError:
+            print(f"Copying {input_filepath} to {output_filepath}")
+            shutil.copyfile(input_filepath, tmp_path)
+
+    os.replace(tmp_path, output_filepath)
+    # If the output already was a hardlink to the input, the replacement does nothing and the link is left over
+    tmp_path.unlink(missing_ok=True)
+
+
+def _file_state(filepath: Path, previous: dict | None = None) -> dict:
+    """Get the size, modification time and SHA256 hash of a file.
+
+    The hash is only computed if the size or modification time differ from the previous state,
+    and from the state computed earlier in this run (if any). It's safe to call from several threads.
+    """
+    with _file_state_locks_lock:
+        lock = _file_state_locks.setdefault(str(filepath), threading.Lock())
+
+    with lock:
+        stat = filepath.stat()
+        for state in [previous, _file_states.get(str(filepath))]:
+            if state is not None and state["size"] == stat.st_size and state["mtime_ns"] == stat.st_mtime_ns:
+                return state
+
+        digest = hashlib.sha256()
+        with open(filepath, "rb") as infile:
+            while chunk := infile.read(2 ** 24):
+                digest.update(chunk)
+
+        state = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+        _file_states[str(filepath)] = state
+        return state
+
+
+def load_journal(filepath: Path) -> dict:
+    """Load the level1 ingestion journal, or create an empty one if it doesn't exist."""
+    if filepath.is_file():
+        return json.loads(filepath.read_text())
+    return {}
+
+
+def save_journal(filepath: Path, journal: dict):
+    """Save the level1 ingestion journal. The file is replaced atomically to survive interruptions."""
+    filepath.parent.mkdir(exist_ok=True, parents=True)
+    tmp_path = filepath.with_name(filepath.name + ".tmp")
+    tmp_path.write_text(json.dumps(journal, indent=1))
+    os.replace(tmp_path, filepath)
+
+def _gather_line(level0_dir: Path, level1_dir: Path, orig_dir: str, radar_id: str, previous_sources: dict) -> tuple[dict, Path | None, dict]:
+    """List the level0 files of a line and get their states (see _file_state).
+
+    Getting the states reads every changed file in full, so this also fetches files that are only
+    downloaded on demand (like in a synced OneDrive folder) and leaves them in the page cache.
+    It runs in a prefetch thread, so it's recorded as a background stage (see instrumentation.background_stage),
+    which keeps its time and I/O out of the preprocessing stages that run at the same time.
+
+    Returns
+    -------
+    The (input, output) filepaths per suffix, the better GPS track (if any) and the states of the sources.
+    """
+    with background_stage("prefetch_level0", level0_dir / orig_dir):
+        filepaths = list((level0_dir / orig_dir).iterdir())
+        if len(filepaths) == 0:
+            raise ValueError(f"Directory {orig_dir} is empty")
 
-def create_renaming_plan():
+        renamed_files = {}
+        for filepath in filepaths:
+            new_filename = radar_id + filepath.suffix
+            new_filepath = level1_dir / radar_id.split("-")[0] / radar_id / new_filename
+
+            if "mala" in radar_id and filepath.suffix not in [".cor", ".rad", ".rd3"]:
+                continue
+            if "pulseekko" in radar_id and filepath.suffix not in [".hd", ".gp2", ".dt1"]:
+                continue
+
+            renamed_files[new_filepath.suffix] = (filepath, new_filepath)
+
+        better_gps_track = None
+        if "austfonna-profile-2025-100MHz-mala" in radar_id:
+            better_gps_track = level0_dir / r"Austfonna\2025\Level0_COP_Malå_100MHz\kinematic2025_ppp_1s_radar.zip"
+
+        sources = [filepath for filepath, _ in renamed_files.values()] + ([better_gps_track] if better_gps_track is not None else [])
+        source_states = {str(filepath): _file_state(filepath, previous_sources.get(str(filepath))) for filepath in sources}
+
+        return renamed_files, better_gps_track, source_states
+
+
+def create_renaming_plan(prefetch: int = PREFETCH_LINES):
 
     level0_dir = Path(r"C:\Users\satuki\OneDrive - Universitetet i Oslo\PFA_data_Svalbard")
     level1_dir = Path("processed/level1")#.absolute()
@@ -208,42 +337,96 @@ def create_renaming_plan():
 
     }
 
-    for orig_dir, radar_id in renaming.items():
-        filepaths = list((level0_dir / orig_dir).iterdir())
-        if len(filepaths) == 0:
-            raise ValueError(f"Directory {orig_dir} is empty")
-        
-        renamed_files = {}
-        for filepath in filepaths:
-            new_filename = radar_id + filepath.suffix
-            new_filepath = level1_dir / radar_id.split("-")[0] / radar_id / new_filename
-
-            if "mala" in radar_id and filepath.suffix not in [".cor", ".rad", ".rd3"]:
-                continue
-            if "pulseekko" in radar_id and filepath.suffix not in [".hd", ".gp2", ".dt1"]:
-                continue
-            
-            renamed_files[new_filepath.suffix] = (filepath, new_filepath)
+    journal_filepath = level1_dir / "ingest_journal.json"
+    journal = load_journal(journal_filepath)
+
+    # The next lines are read in background threads while the current one is preprocessed,
+    # so the (slow) reads of level0 overlap with the preprocessing. At most prefetch lines are read ahead.
+    lines = iter(renaming.items())
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max(1, prefetch)) as executor:
+
+        def submit_next():
+            if (line := next(lines, None)) is not None:
+                orig_dir, radar_id = line
+                previous_sources = journal.get(radar_id, {"sources": {}})["sources"]
+                pending.append((radar_id, executor.submit(_gather_line, level0_dir, level1_dir, orig_dir, radar_id, previous_sources)))
+
+        for _ in range(max(1, prefetch)):
+            submit_next()
+
+        try:
+            while len(pending) > 0:
+                radar_id, future = pending.popleft()
+                renamed_files, better_gps_track, source_states = future.result()
+                submit_next()
+                _ingest_line(level1_dir, journal_filepath, journal, radar_id, renamed_files, better_gps_track, source_states)
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def _ingest_line(level1_dir: Path, journal_filepath: Path, journal: dict, radar_id: str, renamed_files: dict, better_gps_track: Path | None, source_states: dict):
+    """Preprocess or copy one (gathered) line into level1, unless it's up to date. See _gather_line."""
+    outputs = [new_filepath for _, new_filepath in renamed_files.values()]
+    previous = journal.get(radar_id, {"sources": {}, "outputs": []})
+    # Skip the line if none of its inputs changed since it was last ingested
+    if (
+        {key: state["sha256"] for key, state in source_states.items()} == {key: state["sha256"] for key, state in previous["sources"].items()}
+        and previous["outputs"] == [str(filepath) for filepath in outputs]
+        and all(filepath.is_file() for filepath in outputs)
+    ):
+        if source_states != previous["sources"]:
+            journal[radar_id]["sources"] = source_states
+            save_journal(journal_filepath, journal)
+        return
 
-        if "mala" in radar_id:
-            better_gps_track = None
-            if "austfonna-profile-2025-100MHz-mala" in radar_id:
-                better_gps_track = level0_dir / r"Austfonna\2025\Level0_COP_Malå_100MHz\kinematic2025_ppp_1s_radar.zip"
+    if "mala" in radar_id:
+        # Write to a temporary directory first so that an interrupted run leaves no partial output.
+        # It's outside level1 (so it's never mistaken for data) but on the same filesystem.
+        output_rad_filepath = renamed_files[".rad"][1]
+        output_rad_filepath.parent.mkdir(exist_ok=True, parents=True)
+        (level1_dir.parent / "tmp").mkdir(exist_ok=True, parents=True)
+        with tempfile.TemporaryDirectory(dir=level1_dir.parent / "tmp") as tmp_dir:
+            tmp_rad_filepath = Path(tmp_dir) / output_rad_filepath.name
             preprocess_mala(
-                output_rad_filepath=renamed_files[".rad"][1],
+                output_rad_filepath=tmp_rad_filepath,
                 input_rad_filepath=renamed_files[".rad"][0],
                 input_cor_filepath=renamed_files[".cor"][0],
                 input_rd3_filepath=renamed_files[".rd3"][0],
                 better_gps_path=better_gps_track,
+                cor_cache_dir=level1_dir.parent / COR_CACHE_DIR,
             )
-        else:
-            for (filepath, new_filepath) in renamed_files.values():
-                copy_file(output_filepath=new_filepath, input_filepath=filepath)
-
+            for suffix in [".rd3", ".cor", ".rad"]:
+                os.replace(tmp_rad_filepath.with_suffix(suffix), output_rad_filepath.with_suffix(suffix))
+    elif "pulseekko" in radar_id:
+        # Like above, but the files are only rewritten if they need changes (never for CMP gathers). Otherwise, they're linked
+        output_hd_filepath = renamed_files[".hd"][1]
+        output_hd_filepath.parent.mkdir(exist_ok=True, parents=True)
+        (level1_dir.parent / "tmp").mkdir(exist_ok=True, parents=True)
+        with tempfile.TemporaryDirectory(dir=level1_dir.parent / "tmp") as tmp_dir:
+            tmp_hd_filepath = Path(tmp_dir) / output_hd_filepath.name
+            changed = preprocess_pulseekko(
+                output_hd_filepath=tmp_hd_filepath,
+                input_hd_filepath=renamed_files[".hd"][0],
+                input_dt1_filepath=renamed_files[".dt1"][0],
+                input_gp2_filepath=renamed_files[".gp2"][0] if ".gp2" in renamed_files else None,
+            )
+            for suffix, (filepath, new_filepath) in renamed_files.items():
+                if changed and tmp_hd_filepath.with_suffix(suffix).is_file():
+                    os.replace(tmp_hd_filepath.with_suffix(suffix), new_filepath)
+                else:
+                    copy_file(output_filepath=new_filepath, input_filepath=filepath)
+    else:
+        for (filepath, new_filepath) in renamed_files.values():
+            copy_file(output_filepath=new_filepath, input_filepath=filepath)
 
-                
+    journal[radar_id] = {"sources": source_states, "outputs": [str(filepath) for filepath in outputs]}
+    save_journal(journal_filepath, journal)
 
 
 if __name__ == "__main__":
-    create_renaming_plan()
+    # Every stage is timed and recorded in a run report, which is summarized at the end
+    with run_report(report_filepath(Path("processed/reports"), "level1")):
+        create_renaming_plan()
 
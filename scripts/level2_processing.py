@@ -1,16 +1,242 @@
 from pathlib import Path
+from typing import Callable, Iterator
+import hashlib
+import json
+import os
 import numpy as np
 import shutil
+import tempfile
+
+from instrumentation import instrumented, stage, run_report, report_filepath
 
 REQUIRED_RSGPR_VERSION = "0.4.1"
 
+# The assumed peak memory needed per byte of raw (int16) data when processing a radargram
+MEMORY_PER_DATA_BYTE = 12
+
+# The supported image formats of generate_jpgs, and their maximum width in traces.
+# Longer radargrams are split in strips. WebP has a hard limit of 16383 pixels.
+IMAGE_FORMATS = {"jpg": 60000, "webp": 16383, "png": 60000}
+
+# The version of the trace subsetting that is done before rsgpr (see write_trace_subset).
+# It's recorded in the manifest, so products are rebuilt when the subsetting changes.
+PRE_SUBSET_VERSION = 2
+
+# The number of traces that are read and normalized at a time when rendering images
+RENDER_WINDOW = 4096
+
+# Named netCDF encodings for level2 writes.
+#   complevel: The zlib compression level (1-9)
+#   shuffle: Whether to apply the HDF5 byte shuffle filter before compression
+#   chunk_traces: The chunk length along the trace (x) axis. None means the netCDF default chunking
+#   packing: "float32" to store the data as they are, or "int16" for lossy scale/offset packing
+ENCODING_PROFILES = {
+    "fast": {"complevel": 1, "shuffle": True, "chunk_traces": 2048, "packing": "float32"},
+    "balanced": {"complevel": 4, "shuffle": True, "chunk_traces": 2048, "packing": "int16"},
+    "archive": {"complevel": 9, "shuffle": True, "chunk_traces": None, "packing": "float32"},
+}
+
+# The output formats of level2 data and their suffixes. Zarr data are directory stores.
+OUTPUT_FORMATS = {"netcdf": ".nc", "zarr": ".zarr"}
+
+# The Zarr chunk length along the trace (x) axis, if the encoding profile doesn't define one
+ZARR_CHUNK_TRACES = 2048
+
+
+def _maxplus_quadratic(values: np.ndarray, positions: np.ndarray, alpha: float) -> np.ndarray:
+    """Find the best predecessor of each position under a quadratic transition penalty.
+
+    This solves argmax_j(values[j] - alpha * (positions[i] - positions[j])**2) for every i
+    in linear time, using the lower envelope of parabolas (Felzenszwalb & Huttenlocher, 2012).
+    Like np.argmax, the lowest index is returned on ties.
+
+    Parameters
+    ----------
+    values
+        The score of each position.
+    positions
+        The strictly increasing positions (e.g. frequencies).
+    alpha
+        The weight of the quadratic penalty.
+
+    Returns
+    -------
+    The index of the best predecessor for each position.
+    """
+    if alpha <= 0:
+        return np.full(values.shape, np.argmax(values), dtype=np.int32)
+
+    pos = positions.tolist()
+    # Parabola heights (as a minimization problem) shifted to simplify intersections
+    heights = (-values + alpha * positions ** 2).tolist()
+    n = len(pos)
+
+    # The parabolas in the envelope and the position from which they are the lowest
+    hull = [0] * n
+    bounds = [0.] * (n + 1)
+    bounds[0] = -np.inf
+    bounds[1] = np.inf
+    k = 0
+    for q in range(1, n):
+        intersection = (heights[q] - heights[hull[k]]) / (2 * alpha * (pos[q] - pos[hull[k]]))
+        # Remove parabolas that are never the lowest anymore
+        while intersection <= bounds[k]:
+            k -= 1
+            intersection = (heights[q] - heights[hull[k]]) / (2 * alpha * (pos[q] - pos[hull[k]]))
+        k += 1
+        hull[k] = q
+        bounds[k] = intersection
+        bounds[k + 1] = np.inf
+
+    best = np.empty(n, dtype=np.int32)
+    k = 0
+    for i in range(n):
+        while bounds[k + 1] < pos[i]:
+            k += 1
+        best[i] = hull[k]
+
+    return best
+
+
+def _maxplus_quadratic_batched(values: np.ndarray, positions: np.ndarray, alpha: float) -> np.ndarray:
+    """Find the best predecessor of each position under a quadratic transition penalty, for many rows of values.
+
+    This solves the same problem as _maxplus_quadratic on every row, with vectorized passes over all rows at once.
+    Expanding the penalty, each predecessor j is a line (values[j] - alpha * positions[j]**2) + 2 * alpha * positions[j] * x,
+    and the best predecessor of a position is the highest line there. Every pass removes the lines that are
+    nowhere above both of their remaining neighbours, until only the upper envelope is left.
+    Each position is then looked up among the intersections of the envelope.
+    Like np.argmax, the lowest index is returned on ties (up to rounding, as in _maxplus_quadratic).
+
+    Parameters
+    ----------
+    values
+        The score of each position, with the shape (..., positions).
+    positions
+        The strictly increasing positions (e.g. frequencies).
+    alpha
+        The weight of the quadratic penalty.
+
+    Returns
+    -------
+    The index of the best predecessor for each position, with the same shape as values.
+    """
+    if alpha <= 0:
+        return np.broadcast_to(np.argmax(values, axis=-1)[..., None], values.shape).astype(np.int32)
+
+    shape = values.shape
+    values = values.reshape((-1, shape[-1]))
+    n_rows, n = values.shape
+    rows = np.arange(n_rows)[:, None]
+    indices = np.arange(n)
+
+    slopes = 2 * alpha * positions
+    offsets = values - alpha * positions ** 2
+
+    def neighbours(kept: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Get the previous (or the same) and next (or the same) kept index of every index."""
+        previous = np.maximum.accumulate(np.where(kept, indices, 0), axis=1)
+        following = np.minimum.accumulate(np.where(kept, indices, n - 1)[:, ::-1], axis=1)[:, ::-1]
+        previous[:, 1:] = previous[:, :-1].copy()
+        following[:, :-1] = following[:, 1:].copy()
+        return previous, following
+
+    kept = np.ones((n_rows, n), dtype=bool)
+    while n > 2:
+        previous, following = neighbours(kept)
+        # The middle line is removed if it is not above the intersection of its neighbours.
+        # The first and last lines are always kept, as their neighbour is themselves.
+        removed = (
+            (offsets - np.take_along_axis(offsets, previous, axis=1)) * (slopes[following] - slopes[previous])
+            <= (np.take_along_axis(offsets, following, axis=1) - np.take_along_axis(offsets, previous, axis=1)) * (slopes - slopes[previous])
+        )
+        removed &= kept & (previous < indices) & (indices < following)
+        if not removed.any():
+            break
+        kept &= ~removed
+
+    # The position from which each line of the envelope is the highest. The first line is the
+    # highest from the start, so it has no start.
+    previous = neighbours(kept)[0]
+    row, line = np.nonzero(kept & (previous < indices))
+    before = previous[row, line]
+    starts = np.full((n_rows, n), np.inf)
+    starts[row, line] = (offsets[row, before] - offsets[row, line]) / (slopes[line] - slopes[before])
+
+    # The envelope line of each position is given by the number of starts below it. All rows are counted
+    # at once by sorting the starts and positions together, with positions first on ties.
+    keys = np.concatenate([starts, np.broadcast_to(positions, (n_rows, n))], axis=1)
+    is_start = np.broadcast_to(np.repeat([1, 0], n), keys.shape)
+    is_start = np.take_along_axis(is_start, np.lexsort((is_start, keys), axis=-1), axis=-1)
+    ranks = np.cumsum(is_start, axis=-1)[is_start == 0].reshape((n_rows, n))
+
+    envelope = np.zeros((n_rows, n), dtype=np.int32)
+    row, line = np.nonzero(kept)
+    envelope[row, np.cumsum(kept, axis=1)[row, line] - 1] = line
+
+    return envelope[rows, ranks].reshape(shape)
+
+
+def _track_ridge(log_power: np.ndarray, freqs: np.ndarray, alpha: float) -> np.ndarray:
+    """Track the strongest smooth ridge through a (frequency, time) spectrogram.
+
+    Viterbi dynamic programming is used, with a quadratic penalty on frequency jumps.
+    Each time step costs O(F) through _maxplus_quadratic instead of O(F^2). Several spectrograms
+    are stepped through together with _maxplus_quadratic_batched, without a loop over them.
+
+    Parameters
+    ----------
+    log_power
+        The log power spectrogram with the shape (..., frequencies, time).
+        Leading dimensions are tracked independently, but in the same vectorized pass.
+    freqs
+        The frequencies of the spectrogram.
+    alpha
+        The weight of the quadratic frequency jump penalty.
+
+    Returns
+    -------
+    The frequency index of the ridge at each time step, with the shape (..., time).
+    """
+    *batch_shape, n_freqs, n_steps = log_power.shape
+    log_power = log_power.reshape((-1, n_freqs, n_steps))
+    rows = np.arange(log_power.shape[0])[:, None]
+
+    dp = log_power[:, :, 0].copy()
+    ptr = np.empty(log_power.shape, dtype=np.int32)
+    ptr[:, :, 0] = -1
+
+    if log_power.shape[0] == 1:
+        # The list-based envelope has less overhead for a single spectrogram
+        def maxplus(values: np.ndarray) -> np.ndarray:
+            return _maxplus_quadratic(values[0], freqs, alpha)[None, :]
+    else:
+        def maxplus(values: np.ndarray) -> np.ndarray:
+            return _maxplus_quadratic_batched(values, freqs, alpha)
+
+    for k in range(1, n_steps):
+        best_j = maxplus(dp)
+        dp = log_power[:, :, k] + (dp[rows, best_j] - alpha * (freqs - freqs[best_j]) ** 2)
+        ptr[:, :, k] = best_j
+
+    # backtrack best path
+    rows = rows[:, 0]
+    ridge = np.empty((log_power.shape[0], n_steps), dtype=np.int32)
+    ridge[:, -1] = np.argmax(dp, axis=-1)
+    for k in range(n_steps - 2, -1, -1):
+        ridge[:, k] = ptr[rows, ridge[:, k + 1], k + 1]
+
+    return ridge.reshape((*batch_shape, n_steps))
+
+
 def lowfreq_corr(x: np.ndarray, fs: float, fmin: float = 0.003, fmax: float = 0.3, alpha: float = 1500., sigma: float = 0.02, min_att: float = 1e-3):
     """Get a correction factor for low-frequency undulations in a signal.
 
     Parameters
     ----------
     x
-        The signal to extract a correction factor from
+        The signal to extract a correction factor from. If multidimensional, each signal
+        along the last axis is corrected independently in one batched call.
     fs
         The sampling frequency in [s-1]
     fmin/fmax
@@ -27,9 +253,9 @@ def lowfreq_corr(x: np.ndarray, fs: float, fmin: float = 0.003, fmax: float = 0.
     The estimated correction to subtract to the original signal.
     """
     import scipy.signal
-    x = 1 - (x / x.mean())
-    N = x.size
-    x0 = x - np.median(x)  # robust DC removal
+    x = 1 - (x / x.mean(axis=-1, keepdims=True))
+    N = x.shape[-1]
+    x0 = x - np.median(x, axis=-1, keepdims=True)  # robust DC removal
 
     # --- STFT settings ---
     nperseg = 2048 if N >= 2048 else max(256, (N//2)*2)
@@ -39,60 +265,39 @@ def lowfreq_corr(x: np.ndarray, fs: float, fmin: float = 0.003, fmax: float = 0.
         x0, fs=fs, window="hann",
         nperseg=nperseg, noverlap=noverlap,
         detrend=False, return_onesided=True,
-        boundary="zeros", padded=True
+        boundary="zeros", padded=True, axis=-1
     )
+    # Z has the shape (..., frequencies, time)
     S = np.abs(Z)
 
     # --- target band where the artifact lives ---
     band = (f >= fmin) & (f <= fmax)
     fi = np.where(band)[0]
     fb = f[fi]
-    Sb = S[fi, :]
+    Sb = S[..., fi, :]
 
     # --- ridge tracking via dynamic programming (Viterbi) ---
-    logSb = np.log(Sb + 1e-12)
-    Df2 = (fb[:, None] - fb[None, :])**2  # Hz^2 pairwise distances
-
-    dp = np.empty(logSb.shape)
-    ptr = np.empty(logSb.shape, dtype=np.int32)
-
-    dp[:, 0] = logSb[:, 0]
-    ptr[:, 0] = -1
-
-    for k in range(1, Sb.shape[1]):
-        prev = dp[:, k-1]
-        scores = prev[None, :] - alpha * Df2
-        best_j = np.argmax(scores, axis=1)
-        dp[:, k] = logSb[:, k] + scores[np.arange(Sb.shape[0]), best_j]
-        ptr[:, k] = best_j
-
-    # backtrack best path
-    ridge_rel = np.empty(Sb.shape[1], dtype=np.int32)
-    ridge_rel[-1] = int(np.argmax(dp[:, -1]))
-    for k in range(logSb.shape[1]-2, -1, -1):
-        ridge_rel[k] = ptr[ridge_rel[k+1], k+1]
+    ridge_rel = _track_ridge(np.log(Sb + 1e-12), fb, alpha)
 
     ridge_idx = fi[ridge_rel]
     ridge_f = f[ridge_idx]
 
     # --- soft notch mask around ridge (Gaussian in frequency) ---
-    mask = np.ones_like(Z, dtype=float)
-    for k in range(Sb.shape[1]):
-        f0 = ridge_f[k]
-        g = np.exp(-0.5 * ((f - f0) / sigma)**2)
-        att = 1 - (1 - min_att) * g
-        mask[:, k] *= att
+    g = np.exp(-0.5 * ((f[:, None] - ridge_f[..., None, :]) / sigma)**2)
+    mask = 1 - (1 - min_att) * g
 
     # --- inverse STFT back to time domain ---
     _, x_clean = scipy.signal.istft(
         Z * mask, fs=fs, window="hann",
         nperseg=nperseg, noverlap=noverlap,
-        input_onesided=True, boundary=True
+        input_onesided=True, boundary=True,
+        time_axis=-1, freq_axis=-2
     )
 
-    return x - x_clean[:N]
+    return x - x_clean[..., :N]
 
 
+@instrumented("input_filepath")
 def run_rsgpr(
     input_filepath: Path | str,
     output_filepath: Path | str,
@@ -138,79 +343,658 @@ def run_rsgpr(
     shutil.move(tmp_path, output_filepath)
 
 
-def normalize(data: np.ndarray, contrast: float = 0.9):
-    """Normalize the data and convert to an unsigned 8 bit integer array."""
-    data_abs = np.abs(data)
-    minval_abs, maxval_abs = np.percentile(np.abs(data_abs[50:]), [1, 99])
-    data_abs = np.clip(contrast * (data - minval_abs) / (maxval_abs - minval_abs + 1e-12), 0, 1)
+class AbsHistogram:
+    """A streaming histogram of absolute values, for approximate percentiles in a single pass.
 
-    return (data_abs * 255).astype("uint8")
+    Zeros are counted separately. The bins cover the other values in [0, upper), where upper is
+    set from the first nonzero maximum and doubled (merging the bins pairwise) whenever larger
+    values arrive. The error of an estimated percentile is at most one bin width,
+    i.e. upper / n_bins <= 2 * max(abs(data)) / n_bins.
+    """
 
+    def __init__(self, n_bins: int = 2 ** 16):
+        self.n_bins = n_bins
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+        self.zeros = 0
+        self.upper = 0.
+
+    def update(self, data: np.ndarray):
+        """Add the absolute values of a chunk of data to the histogram. NaNs and infinite values are ignored."""
+        if np.issubdtype(data.dtype, np.integer):
+            # The absolute of the most negative integer overflows in its own type
+            data_abs = np.abs(data.astype(np.int64))
+        else:
+            data_abs = np.abs(data[np.isfinite(data)])
+        nonzero = data_abs[data_abs > 0]
+        self.zeros += data_abs.size - nonzero.size
+        if nonzero.size == 0:
+            return
+        maxval = float(nonzero.max())
+
+        if self.upper == 0:
+            self.upper = 2. ** np.ceil(np.log2(maxval))
+        while maxval >= self.upper:
+            merged = self.counts.reshape((-1, 2)).sum(axis=1)
+            self.counts[:] = 0
+            self.counts[:merged.size] = merged
+            self.upper *= 2
+
+        bins = (nonzero * (self.n_bins / self.upper)).astype(np.int64)
+        np.minimum(bins, self.n_bins - 1, out=bins)
+        self.counts += np.bincount(bins, minlength=self.n_bins)
+
+    def percentiles(self, q: list[float]) -> np.ndarray:
+        """Estimate percentiles (0-100) of the absolute values, interpolating within bins.
+
+        Like np.nanpercentile, the percentiles are NaN if no (finite) values have been added.
+        """
+        cumulative = np.cumsum(self.counts)
+        total = self.zeros + cumulative[-1]
+        if total == 0:
+            return np.full(np.shape(q), np.nan)
+        if cumulative[-1] == 0:
+            return np.zeros(np.shape(q))
+        bin_width = self.upper / self.n_bins
+
+        # The ranks follow the default (linear) method of np.percentile, counted from the first nonzero value
+        ranks = np.asarray(q, dtype=float) / 100 * (total - 1) - self.zeros
+        nonzero_ranks = np.maximum(ranks, 0)
+        bins = np.searchsorted(cumulative, nonzero_ranks, side="right")
+        before = np.where(bins > 0, cumulative[np.maximum(bins - 1, 0)], 0)
+        fraction = np.clip((nonzero_ranks - before + 0.5) / np.maximum(self.counts[bins], 1), 0, 1)
+
+        # Ranks between the last zero and the first nonzero value interpolate from zero
+        return (bins + fraction) * bin_width * np.clip(ranks + 1, 0, 1)
+
+
+def contrast_limits(data: np.ndarray) -> tuple[float, float]:
+    """Get the 1st and 99th percentiles of the absolute data, skipping the first 50 samples."""
+    minval_abs, maxval_abs = np.percentile(np.abs(data[50:]), [1, 99])
+    return minval_abs, maxval_abs
+
+
+def approx_contrast_limits(data: np.ndarray, chunk_size: int = 4096) -> tuple[float, float]:
+    """Estimate the contrast limits (see contrast_limits) with a streaming histogram.
+
+    Unlike contrast_limits, this only needs one chunk of temporary memory.
+    """
+    histogram = AbsHistogram()
+    for start in range(0, data.shape[1], chunk_size):
+        histogram.update(data[50:, start:start + chunk_size])
 
-def fix_power_variation(filepath: Path):
-    """Correct for horizontal variations in power in a dataset.
-    This will overwrite the original data."""
+    minval_abs, maxval_abs = histogram.percentiles([1, 99])
+    return minval_abs, maxval_abs
+
+
+def _estimate_contrast_limits(data_array, chunk_size: int = 4096) -> tuple[float, float]:
+    """Estimate the contrast limits of a (lazily loaded) radargram, reading a window of traces at a time.
+
+    The limits are consistent for the whole radargram without loading it into memory.
+    """
+    histogram = AbsHistogram()
+    for start in range(0, data_array.shape[1], chunk_size):
+        histogram.update(data_array.isel(x=slice(start, start + chunk_size)).values[50:])
+
+    minval_abs, maxval_abs = histogram.percentiles([1, 99])
+    return minval_abs, maxval_abs
+
+
+def normalize(data: np.ndarray, contrast: float = 0.9, limits: tuple[float, float] | None = None, chunk_size: int = 4096, out: np.ndarray | None = None):
+    """Normalize the data and convert to an unsigned 8 bit integer array.
+
+    Integer data are mapped through a lookup table. Other data are converted in chunks of traces
+    with in-place operations, so only one chunk of temporary memory is needed.
+
+    Parameters
+    ----------
+    data
+        The data to normalize.
+    contrast
+        The fraction of the 8 bit range that the contrast limits are scaled to.
+    limits
+        Optional. The contrast limits to use (see contrast_limits). If not given, they are
+        estimated from the data with approx_contrast_limits.
+    chunk_size
+        The number of traces to convert at a time.
+    out
+        Optional. A uint8 array of the same shape to write the result in, instead of a new array.
+    """
+    if limits is None:
+        limits = approx_contrast_limits(data, chunk_size=chunk_size)
+    minval_abs, maxval_abs = limits
+
+    def convert(values: np.ndarray, out: np.ndarray):
+        # The same operations as clip(contrast * (values - minval) / (maxval - minval), 0, 1) * 255, but in place
+        np.subtract(values, minval_abs, out=out)
+        np.multiply(contrast, out, out=out)
+        np.divide(out, maxval_abs - minval_abs + 1e-12, out=out)
+        np.clip(out, 0, 1, out=out)
+        np.multiply(out, 255, out=out)
+
+    if np.issubdtype(data.dtype, np.integer) and data.dtype.itemsize <= 2:
+        info = np.iinfo(data.dtype)
+        lut = np.empty(int(info.max) - int(info.min) + 1)
+        convert(np.arange(info.min, int(info.max) + 1), lut)
+        output = lut.astype("uint8")[data.astype(np.int32) - info.min]
+        if out is None:
+            return output
+        out[:] = output
+        return out
+
+    output = np.empty(data.shape, dtype="uint8") if out is None else out
+    buffer = np.empty((data.shape[0], min(chunk_size, data.shape[1])), dtype=np.result_type(data.dtype, minval_abs, np.float32))
+    for start in range(0, data.shape[1], chunk_size):
+        values = data[:, start:start + chunk_size]
+        converted = buffer[:, :values.shape[1]]
+        convert(values, converted)
+        output[:, start:start + chunk_size] = converted
+
+    return output
+
+
+def _band_weights(depth: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    """Get (depth, bands) weights that linearly interpolate band values to each depth.
+
+    The weights go to zero towards the surface (depth 0) and are constant below the deepest band center.
+    """
+    if centers[0] > 0:
+        centers = np.r_[0., centers]
+        values = np.r_[np.zeros((1, centers.size - 1)), np.eye(centers.size - 1)]
+    else:
+        values = np.eye(centers.size)
+
+    return np.stack([np.interp(depth, centers, values[:, i]) for i in range(values.shape[1])], axis=1)
+
+
+def netcdf_encoding(data, profile: str = "archive", data_range: tuple[float, float] | None = None) -> dict[str, dict]:
+    """Get the netCDF encoding of a level2 dataset from a named profile in ENCODING_PROFILES.
+
+    Parameters
+    ----------
+    data
+        The (xarray) dataset to encode.
+    profile
+        The name of the encoding profile.
+    data_range
+        Optional. The (min, max) range of the "data" variable for int16 packing. Computed if not given.
+
+    Returns
+    -------
+    The encoding of each data variable, to be given to xarray.Dataset.to_netcdf.
+    """
+    if profile not in ENCODING_PROFILES:
+        raise ValueError(f"Unknown encoding profile: {profile}. Choices: {list(ENCODING_PROFILES)}")
+    settings = ENCODING_PROFILES[profile]
+
+    encoding = {}
+    for name, var in data.data_vars.items():
+        encoding[name] = {"zlib": True, "complevel": settings["complevel"], "shuffle": settings["shuffle"]}
+        if settings["chunk_traces"] is not None and "x" in var.dims:
+            encoding[name]["chunksizes"] = tuple(min(settings["chunk_traces"], size) if dim == "x" else size for dim, size in zip(var.dims, var.shape))
+
+    if settings["packing"] == "int16":
+        if data_range is None:
+            data_range = (float(np.nanmin(data["data"].values)), float(np.nanmax(data["data"].values)))
+        vmin, vmax = data_range
+        # Use the range -32767 to 32767, leaving -32768 as the fill value
+        encoding["data"] |= {
+            "dtype": "int16",
+            "scale_factor": (vmax - vmin) / 65534 if vmax > vmin else 1.,
+            "add_offset": (vmax + vmin) / 2,
+            "_FillValue": np.int16(-32768),
+        }
+
+    return encoding
+
+
+def _zarr_compressor(complevel: int, shuffle: bool) -> dict:
+    """Get the Zarr compressor encoding that corresponds to a netCDF compression level."""
+    import zarr
+
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        from zarr.codecs import BloscCodec
+        return {"compressors": [BloscCodec(cname="zstd", clevel=complevel, shuffle="shuffle" if shuffle else "noshuffle")]}
+
+    from numcodecs import Blosc
+    return {"compressor": Blosc(cname="zstd", clevel=complevel, shuffle=Blosc.SHUFFLE if shuffle else Blosc.NOSHUFFLE)}
+
+
+def zarr_encoding(data, profile: str = "archive", data_range: tuple[float, float] | None = None) -> dict[str, dict]:
+    """Get the Zarr encoding of a level2 dataset from a named profile in ENCODING_PROFILES.
+
+    The packing is the same as in netcdf_encoding. Variables along the trace (x) axis are always chunked
+    along it (ZARR_CHUNK_TRACES if the profile has no chunk length), so windows of traces can be read on their own.
+
+    Parameters
+    ----------
+    data
+        The (xarray) dataset to encode.
+    profile
+        The name of the encoding profile.
+    data_range
+        Optional. The (min, max) range of the "data" variable for int16 packing. Computed if not given.
+
+    Returns
+    -------
+    The encoding of each data variable, to be given to xarray.Dataset.to_zarr.
+    """
+    netcdf = netcdf_encoding(data, profile, data_range=data_range)
+    settings = ENCODING_PROFILES[profile]
+    chunk_traces = settings["chunk_traces"] or ZARR_CHUNK_TRACES
+
+    encoding = {}
+    for name, var in data.data_vars.items():
+        encoding[name] = {key: netcdf[name][key] for key in ["dtype", "scale_factor", "add_offset", "_FillValue"] if key in netcdf[name]}
+        encoding[name] |= _zarr_compressor(settings["complevel"], settings["shuffle"])
+        if "x" in var.dims:
+            encoding[name]["chunks"] = tuple(min(chunk_traces, size) if dim == "x" else size for dim, size in zip(var.dims, var.shape))
+
+    return encoding
+
+
+def open_level2(filepath: Path):
+    """Lazily open a level2 dataset, either a netCDF (.nc) file or a Zarr (.zarr) store.
+
+    Only the parts that are accessed are read, which for Zarr stores means only the chunks of those traces.
+    """
     import xarray as xr
-    xr.set_options(display_style='text')
+
+    if filepath.suffix == ".zarr":
+        return xr.open_zarr(filepath, consolidated=True, chunks=None)
+    return xr.open_dataset(filepath)
+
+
+def _replace_output(new_filepath: Path, filepath: Path):
+    """Move a finished file or Zarr store in place of an older one."""
+    if new_filepath.is_dir():
+        if filepath.is_dir():
+            shutil.rmtree(filepath)
+        os.replace(new_filepath, filepath)
+    else:
+        shutil.move(new_filepath, filepath)
+
+
+def write_level2(data, filepath: Path, encoding_profile: str = "archive"):
+    """Write a level2 dataset in the format of the filepath suffix (see OUTPUT_FORMATS).
+
+    The data are written beside the filepath first, and only moved in place when done.
+    """
     new_filepath = filepath.with_name(filepath.name + ".tmp")
-    with xr.open_dataset(filepath) as data:
-        if data.x.shape[0] <= 256:
-            print(f"Skipping power correction on {filepath}: too short file")
+    if filepath.suffix == ".zarr":
+        if new_filepath.is_dir():
+            shutil.rmtree(new_filepath)
+        data.to_zarr(new_filepath, mode="w", encoding=zarr_encoding(data, encoding_profile), consolidated=True)
+    else:
+        data.to_netcdf(new_filepath, encoding=netcdf_encoding(data, encoding_profile))
+    _replace_output(new_filepath, filepath)
 
-        if data.attrs.get("power_fixed", 0) == 1:
-            print(f"Skipping power correction on {filepath}: it has already been done")
-            return
 
-        print(f"Estimating and applying power variation correction.")
+def _estimate_power_correction(data, n_bands: int = 1, chunk_size: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """Estimate the horizontal power variation correction of a level2 dataset.
+
+    Parameters
+    ----------
+    data
+        The (xarray) dataset to estimate the correction of.
+    n_bands
+        The number of depth bands to estimate corrections in. See fix_power_variation.
+    chunk_size
+        Optional. The number of traces to read at a time when averaging the depth bands.
+
+    Returns
+    -------
+    The (depth, bands) weights and (bands, traces) corrections. See _correction_factor.
+    """
+    if n_bands == 1:
         line = np.abs(data.data.isel(y=slice(data.y.shape[0] - 10, None))).mean("y").values
         corr = lowfreq_corr(line, 1 / data.attrs["time-interval"])
 
         # line = np.abs(data.data.isel(y=slice(data.y.shape[0] - 10))).mean("y").rolling(x=50, min_periods=1, center=True).mean().values
         # corr = (1 - (line / line.mean()))
 
-        data["data"] *= 1 + corr[None, :] * (data["depth"] / data["depth"].max()).values[:, None]
+        return (data["depth"] / data["depth"].max()).values[:, None], corr[None, :]
 
-        data.attrs["power_fixed"] = 1
+    edges = np.linspace(0, data.y.shape[0], n_bands + 1).astype(int)
+    bands = [slice(start, end) for start, end in zip(edges[:-1], edges[1:])]
 
-        # Force every attribute to be ASCII characters only. This stopped files from being saved on some computers
-        for key, value in data.attrs.items():
-            if isinstance(value, str):
-                data.attrs[key] = value.encode("ascii", errors="ignore").decode()
-        
-        data.to_netcdf(new_filepath, encoding={v: {"complevel": 9, "zlib": True} for v in data.data_vars})
+    chunk_size = chunk_size or data.x.shape[0]
+    lines = np.concatenate([
+        np.stack([np.abs(data.data.isel(x=slice(start, start + chunk_size), y=band)).mean("y").values for band in bands])
+        for start in range(0, data.x.shape[0], chunk_size)
+    ], axis=1)
+    corrs = lowfreq_corr(lines, 1 / data.attrs["time-interval"])
+
+    depth = data["depth"].values
+    centers = np.array([depth[band].mean() for band in bands])
+    return _band_weights(depth, centers), corrs
+
+
+def _correction_factor(weights: np.ndarray, corrs: np.ndarray, traces: slice = slice(None)) -> np.ndarray:
+    """Get the (depth, traces) factor to multiply the data with for a range of traces."""
+    if corrs.shape[0] == 1:
+        return 1 + corrs[0, traces][None, :] * weights[:, 0][:, None]
+    return 1 + weights @ corrs[:, traces]
 
-    shutil.move(new_filepath, filepath)
 
+def _corrected_blocks(data, weights: np.ndarray, corrs: np.ndarray, chunk_size: int):
+    """Read and correct the "data" variable one block of traces at a time.
 
-def generate_jpgs(processed_filepath: Path, redo: bool = False):
-    """Generate JPG versions of a processed radargram.
+    Yields
+    ------
+    The slice of traces and the corrected (depth, traces) block.
+    """
+    for start in range(0, data.x.shape[0], chunk_size):
+        traces = slice(start, start + chunk_size)
+        block = data["data"].isel(x=traces).values
+        # This has the same precision as the in-place multiplication of the in-memory path
+        yield traces, (block * _correction_factor(weights, corrs, traces)).astype(block.dtype)
+
+
+def _write_corrected_chunked(data, output_filepath: Path, weights: np.ndarray, corrs: np.ndarray, chunk_size: int, encoding_profile: str = "archive"):
+    """Write a level2 dataset with the power correction applied, one block of traces at a time.
+
+    All variables except "data" are written with xarray. The "data" variable is then appended
+    with netCDF4 and filled block by block, so only one block is in memory at a time.
+    The blocks are aligned with the netCDF chunks, so no chunk is written more than once: a profile
+    without a chunk length is chunked by the block size, and otherwise the block size is rounded to whole chunks.
+    """
+    import netCDF4
+
+    chunk_traces = ENCODING_PROFILES[encoding_profile]["chunk_traces"]
+    if chunk_traces is not None:
+        chunk_size = chunk_traces * max(1, chunk_size // chunk_traces)
+
+    data_range = None
+    if ENCODING_PROFILES[encoding_profile]["packing"] == "int16":
+        # The packing needs the range of the corrected data, which requires one extra pass
+        vmin, vmax = np.inf, -np.inf
+        for _, block in _corrected_blocks(data, weights, corrs, chunk_size):
+            vmin, vmax = min(vmin, float(np.nanmin(block))), max(vmax, float(np.nanmax(block)))
+        data_range = (vmin, vmax)
+    encoding = netcdf_encoding(data, encoding_profile, data_range=data_range)
+    if chunk_traces is None:
+        var = data["data"]
+        encoding["data"]["chunksizes"] = tuple(min(chunk_size, size) if dim == "x" else size for dim, size in zip(var.dims, var.shape))
+
+    skeleton = data.drop_vars("data")
+    skeleton.to_netcdf(output_filepath, encoding={v: encoding[v] for v in skeleton.data_vars})
+
+    # Like the in-memory path, the encoding of the source file (e.g. its packing) is not kept
+    var = data["data"]
+    var_encoding = encoding["data"]
+    fill_value = var_encoding.get("_FillValue", np.nan if np.issubdtype(var.dtype, np.floating) else None)
+    with netCDF4.Dataset(output_filepath, "a") as dataset:
+        out = dataset.createVariable(
+            "data",
+            var_encoding.get("dtype", var.dtype),
+            var.dims,
+            zlib=True,
+            complevel=var_encoding["complevel"],
+            shuffle=var_encoding["shuffle"],
+            chunksizes=encoding["data"].get("chunksizes"),
+            fill_value=fill_value,
+        )
+        out.setncatts({key: var_encoding[key] for key in ["scale_factor", "add_offset"] if key in var_encoding} | var.attrs)
+
+        packed = "scale_factor" in var_encoding
+        if packed:
+            # Pack the values like xarray does instead of netCDF4, so both paths give the same result
+            out.set_auto_scale(False)
+
+        for traces, block in _corrected_blocks(data, weights, corrs, chunk_size):
+            if packed:
+                block = (block - var_encoding["add_offset"]) / var_encoding["scale_factor"]
+                # Clip to the range of the packed type (except the fill value) so rounding can't wrap around
+                info = np.iinfo(var_encoding["dtype"])
+                np.clip(block, info.min + 1, info.max, out=block)
+                block = np.around(np.where(np.isnan(block), fill_value, block)).astype(var_encoding["dtype"])
+            out[:, traces] = block
+
+
+def _write_zarr_blocks(data, output_filepath: Path, blocks: Callable[[int], Iterator[tuple[slice, np.ndarray]]], chunk_size: int, encoding_profile: str = "archive"):
+    """Write a level2 dataset to a Zarr store, one block of traces of the "data" variable at a time.
+
+    The first block creates the store and every following block is appended along the trace (x) axis.
+    The blocks are rounded to whole Zarr chunks so that no chunk is written twice.
 
     Parameters
     ----------
-    processed_filepath
-        The filepath to the processed (.nc) data.
-    redo
-        Reprocess data despite already existing.
+    data
+        The (lazily loaded) dataset to write.
+    output_filepath
+        The filepath of the Zarr store.
+    blocks
+        A function that yields the slice of traces and the (depth, traces) values of each block, given a block size.
+    chunk_size
+        The approximate number of traces per block.
+    encoding_profile
+        The name of the encoding profile to write with (see ENCODING_PROFILES).
     """
-    jpg_path = processed_filepath.with_name(processed_filepath.stem + ".jpg")
-    if jpg_path.is_file() and not redo:
-        return
+    chunk_traces = ENCODING_PROFILES[encoding_profile]["chunk_traces"] or ZARR_CHUNK_TRACES
+    chunk_size = chunk_traces * max(1, chunk_size // chunk_traces)
+
+    data_range = None
+    if ENCODING_PROFILES[encoding_profile]["packing"] == "int16":
+        # The packing needs the range of the written data, which requires one extra pass
+        vmin, vmax = np.inf, -np.inf
+        for _, block in blocks(chunk_size):
+            vmin, vmax = min(vmin, float(np.nanmin(block))), max(vmax, float(np.nanmax(block)))
+        data_range = (vmin, vmax)
+    encoding = zarr_encoding(data, encoding_profile, data_range=data_range)
+
+    for traces, block in blocks(chunk_size):
+        block_data = data.isel(x=traces).load()
+        block_data["data"].values = block
+        if traces.start == 0:
+            block_data.to_zarr(output_filepath, mode="w", encoding=encoding, consolidated=True)
+        else:
+            block_data.to_zarr(output_filepath, append_dim="x", consolidated=True)
+
+
+def _write_corrected_chunked_zarr(data, output_filepath: Path, weights: np.ndarray, corrs: np.ndarray, chunk_size: int, encoding_profile: str = "archive"):
+    """Write a level2 dataset to a Zarr store with the power correction applied, one block of traces at a time."""
+    _write_zarr_blocks(data, output_filepath, lambda size: _corrected_blocks(data, weights, corrs, size), chunk_size, encoding_profile=encoding_profile)
+
+
+def convert_to_zarr(input_filepath: Path, output_filepath: Path, encoding_profile: str = "archive", chunk_size: int = 8 * ZARR_CHUNK_TRACES):
+    """Convert a level2 netCDF file to a Zarr store, one block of traces at a time.
+
+    Parameters
+    ----------
+    input_filepath
+        The filepath to the level2 (.nc) data.
+    output_filepath
+        The filepath of the Zarr (.zarr) store. It is replaced if it exists.
+    encoding_profile
+        The name of the encoding profile to write with (see ENCODING_PROFILES).
+    chunk_size
+        The approximate number of traces to read at a time.
+    """
+    import xarray as xr
+
+    def blocks(size: int):
+        for start in range(0, data.x.shape[0], size):
+            traces = slice(start, start + size)
+            yield traces, data["data"].isel(x=traces).values
+
+    new_filepath = output_filepath.with_name(output_filepath.name + ".tmp")
+    with xr.open_dataset(input_filepath) as data:
+        _write_zarr_blocks(data, new_filepath, blocks, chunk_size, encoding_profile=encoding_profile)
+    _replace_output(new_filepath, output_filepath)
+
+
+def _prepare_power_correction(data, filepath: Path, n_bands: int = 1, chunk_size: int | None = None) -> tuple[np.ndarray, np.ndarray] | None:
+    """Estimate the power variation correction of a dataset and mark its attributes as corrected.
 
+    The correction itself is not applied (see _correction_factor), so the caller can apply it in memory or in blocks.
+
+    Returns
+    -------
+    The (depth, bands) weights and (bands, traces) corrections, or None if the correction has already been done.
+    """
+    if data.x.shape[0] <= 256:
+        print(f"Skipping power correction on {filepath}: too short file")
+
+    if data.attrs.get("power_fixed", 0) == 1:
+        print(f"Skipping power correction on {filepath}: it has already been done")
+        return None
+
+    print(f"Estimating and applying power variation correction.")
+    weights, corrs = _estimate_power_correction(data, n_bands=n_bands, chunk_size=chunk_size)
+
+    data.attrs["power_fixed"] = 1
+
+    # Force every attribute to be ASCII characters only. This stopped files from being saved on some computers
+    for key, value in data.attrs.items():
+        if isinstance(value, str):
+            data.attrs[key] = value.encode("ascii", errors="ignore").decode()
+
+    return weights, corrs
+
+
+@instrumented("filepath")
+def fix_power_variation(filepath: Path, n_bands: int = 1, chunk_size: int | None = None, encoding_profile: str = "archive"):
+    """Correct for horizontal variations in power in a dataset.
+    This will overwrite the original data.
+
+    Parameters
+    ----------
+    filepath
+        The filepath to the processed (.nc or .zarr) data.
+    n_bands
+        The number of depth bands to estimate corrections in. With one band, the correction is
+        estimated from the deepest samples and applied with a linear depth ramp. With more bands,
+        the depth axis is split in equally large bands whose corrections are estimated in one batched
+        call and linearly interpolated between the band centers.
+    chunk_size
+        Optional. Stream the data through the correction in blocks of this many traces,
+        which bounds the memory usage. Otherwise, the whole dataset is corrected in memory.
+    encoding_profile
+        The name of the encoding profile to write with (see ENCODING_PROFILES).
+    """
     import xarray as xr
+    xr.set_options(display_style='text')
+    new_filepath = filepath.with_name(filepath.name + ".tmp")
+    with open_level2(filepath) as data:
+        correction = _prepare_power_correction(data, filepath, n_bands=n_bands, chunk_size=chunk_size)
+        if correction is None:
+            return
+        weights, corrs = correction
+
+        if chunk_size is None:
+            data["data"] *= _correction_factor(weights, corrs)
+            if filepath.suffix == ".zarr":
+                data.to_zarr(new_filepath, mode="w", encoding=zarr_encoding(data, encoding_profile), consolidated=True)
+            else:
+                data.to_netcdf(new_filepath, encoding=netcdf_encoding(data, encoding_profile))
+        elif filepath.suffix == ".zarr":
+            _write_corrected_chunked_zarr(data, new_filepath, weights, corrs, chunk_size=chunk_size, encoding_profile=encoding_profile)
+        else:
+            _write_corrected_chunked(data, new_filepath, weights, corrs, chunk_size=chunk_size, encoding_profile=encoding_profile)
+
+    _replace_output(new_filepath, filepath)
+
+
+def _save_image(arr: np.ndarray, filepath: Path):
     import PIL.Image
 
-    with xr.open_dataset(processed_filepath) as data:
-        arr = normalize(data.data.values)
+    PIL.Image.fromarray(arr).save(filepath)
+
+
+def _render_images(data, image_path: Path, max_width: int, streaming: bool = False, workers: int | None = None, window: int = RENDER_WINDOW):
+    """Render a (lazily loaded or in-memory) level2 dataset to one or more images. See generate_jpgs.
+
+    The data are read in windows of traces in this thread (netCDF reads are not thread safe).
+    The windows are normalized into 8 bit strips in the pool, and each finished strip is encoded in the pool.
+    Even a radargram that fits in one strip is thus normalized in parallel. At most as many
+    windows or strips as there are workers are waiting in the pool at a time.
+    """
+    import concurrent.futures
+
+    if workers is None:
+        workers = os.cpu_count() or 1
 
-    maxwidth = 60000
-    if arr.shape[1] > maxwidth:
-        for i, start in enumerate(range(0, arr.shape[1], maxwidth)):
-            end = min(start + maxwidth, arr.shape[1])
-            PIL.Image.fromarray(arr[:, start:end]).save(jpg_path.with_stem(jpg_path.stem + f"_{i}"))
+    n_samples, n_traces = data["data"].shape
+    if n_traces > max_width:
+        starts = list(range(0, n_traces, max_width))
+        filepaths = [image_path.with_stem(image_path.stem + f"_{i}") for i in range(len(starts))]
+    else:
+        starts = [0]
+        filepaths = [image_path]
+
+    if streaming:
+        # Only one window of float data at a time is read, and the strips are 8 bit
+        limits = _estimate_contrast_limits(data["data"], chunk_size=window)
+        def read_window(traces: slice) -> np.ndarray:
+            return data["data"].isel(x=traces).values
     else:
-        PIL.Image.fromarray(arr).save(jpg_path)
+        arr = data["data"].values
+        limits = approx_contrast_limits(arr, chunk_size=window)
+        def read_window(traces: slice) -> np.ndarray:
+            return arr[:, traces]
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending = set()
+
+        def submit(func: Callable, *args, **kwargs) -> concurrent.futures.Future:
+            nonlocal pending
+            if len(pending) >= workers:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            future = executor.submit(func, *args, **kwargs)
+            pending.add(future)
+            return future
+
+        for start, filepath in zip(starts, filepaths):
+            strip = np.empty((n_samples, min(max_width, n_traces - start)), dtype="uint8")
+            windows = []
+            for offset in range(0, strip.shape[1], window):
+                traces = slice(start + offset, start + min(offset + window, strip.shape[1]))
+                # The float64 conversion buffer of normalize is kept to a quarter of a window
+                windows.append(submit(normalize, read_window(traces), limits=limits, chunk_size=max(1, window // 4), out=strip[:, offset:offset + window]))
+
+            for future in windows:
+                future.result()
+            submit(_save_image, strip, filepath)
+
+        for future in pending:
+            future.result()
+
+
+@instrumented("processed_filepath")
+def generate_jpgs(processed_filepath: Path, redo: bool = False, image_format: str = "jpg", streaming: bool = False, workers: int | None = None):
+    """Generate JPG (or other image) versions of a processed radargram.
+
+    If the data are longer than the maximum width of the format (see IMAGE_FORMATS), the image is split in strips.
+
+    Parameters
+    ----------
+    processed_filepath
+        The filepath to the processed (.nc or .zarr) data.
+    redo
+        Reprocess data despite already existing.
+    image_format
+        The image format (and suffix) to save as. One of IMAGE_FORMATS.
+    streaming
+        Read and normalize the data one strip at a time. The contrast limits are then estimated in a
+        first pass that streams every trace through a histogram of absolute values (see AbsHistogram),
+        so that they are consistent between strips. The estimated limits are off by at most one bin width,
+        i.e. 2 * max(abs(data)) / 65536. This bounds the memory usage to a few strips instead of the whole radargram.
+    workers
+        Optional. The number of threads that normalize and encode strips in parallel. Defaults to the number of CPUs.
+    """
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format: {image_format}. Choices: {list(IMAGE_FORMATS)}")
+    max_width = IMAGE_FORMATS[image_format]
+
+    jpg_path = processed_filepath.with_name(processed_filepath.stem + "." + image_format)
+    if jpg_path.is_file() and not redo:
+        return
+
+    with open_level2(processed_filepath) as data:
+        _render_images(data, jpg_path, max_width=max_width, streaming=streaming, workers=workers)
 
-            
 
 def subsetting(radar_key: str) -> tuple[int, int] | None:
     """Get the predetermined trace subsetting information for a given radar_key,
@@ -287,21 +1071,20 @@ def subsetting(radar_key: str) -> tuple[int, int] | None:
         return subset
         
 
-def process_radargram(output_filepath: Path, input_header_filepath: Path, radar_key: str | None = None):
-    """Process one radargram, with steps defined from its filename/radar_key.
-
-    A JPG will be rendered beside the output_filepath.
-    If the data are longer than 60000 traces, the JPG will be split in parts.
+def processing_plan(input_header_filepath: Path, radar_key: str | None = None) -> tuple[list[str], bool]:
+    """Get the processing steps of one radargram, defined from its filename/radar_key.
 
     Parameters
     ----------
-    output_filepath
-        The output .nc filepath to save the data in.
     input_header_filepath
         The input .rad/.hd header filepath for the data to process.
     radar_key
         Optional. The radar_key to use for processing step determination.
         If not provided, it will be determined from the filepath.
+
+    Returns
+    -------
+    The rsgpr steps, and whether the power variation correction should be run.
     """
     if radar_key is None:
         radar_key = input_header_filepath.stem
@@ -349,52 +1132,412 @@ def process_radargram(output_filepath: Path, input_header_filepath: Path, radar_
     if (subset := subsetting(radar_key)) is not None:
         steps.insert(0, f"subset({subset[0]} {subset[1]})")
 
+    return steps, run_fix_power_variation
+
+
+def write_trace_subset(output_header_filepath: Path, input_header_filepath: Path, trace_range: tuple[int, int]) -> Path:
+    """Write a copy of a .rad/.hd file with only a range of traces.
+
+    Only the byte range of the traces is read from the input, and the coordinates are subset to match.
+    rsgpr interpolates the positions of the traces between the fixes by trace number, so the subset keeps
+    anchors for the first and last traces (see preprocess_mala.subset_coordinates): the Malå corfile gets
+    fixes interpolated at exactly the first and last trace, and the pulseEKKO GPS file keeps the nearest fix on each side.
+
+    Parameters
+    ----------
+    output_header_filepath
+        The .rad/.hd header filepath of the copy. The other files are saved beside it.
+    input_header_filepath
+        The .rad/.hd header filepath of the data to subset.
+    trace_range
+        The inclusive (start, end) range of traces to keep (see preprocess_mala.resolve_trace_range).
+
+    Returns
+    -------
+    The output_header_filepath.
+    """
+    if input_header_filepath.suffix == ".rad":
+        from preprocess_mala import load_ramac, save_ramac
+        save_ramac(output_header_filepath, load_ramac(input_header_filepath, mmap=True, trace_range=trace_range))
+    else:
+        from pulseekko import load_pulseekko, save_pulseekko
+        save_pulseekko(output_header_filepath, load_pulseekko(input_header_filepath, mmap=True, trace_range=trace_range))
+
+    return output_header_filepath
+
+
+def _process_single_pass(output_filepath: Path, input_header_filepath: Path, steps: list[str], run_fix_power_variation: bool, encoding_profile: str = "archive", n_bands: int = 1):
+    """Run rsgpr, the power correction and the JPG rendering with only one read and one write of the result.
+
+    rsgpr writes to a scratch file beside the output_filepath, which is loaded into memory once.
+    If the data are power corrected or the output is a Zarr store, the final file is written once from memory.
+    Otherwise, the scratch file is moved in place.
+    """
+    import xarray as xr
+
+    scratch_filepath = output_filepath.with_name(output_filepath.name + ".scratch")
+    run_rsgpr(input_filepath=input_header_filepath, output_filepath=scratch_filepath, steps=steps)
+
+    try:
+        data = xr.load_dataset(scratch_filepath)
+
+        correction = None
+        if run_fix_power_variation:
+            with stage("fix_power_variation", output_filepath):
+                correction = _prepare_power_correction(data, output_filepath, n_bands=n_bands)
+                if correction is not None:
+                    data["data"] *= _correction_factor(*correction)
+                    if output_filepath.suffix != ".zarr":
+                        write_level2(data, output_filepath, encoding_profile=encoding_profile)
+
+        if output_filepath.suffix == ".zarr":
+            write_level2(data, output_filepath, encoding_profile=encoding_profile)
+        elif correction is None:
+            shutil.move(scratch_filepath, output_filepath)
+
+        with stage("generate_jpgs", output_filepath):
+            _render_images(data, output_filepath.with_suffix(".jpg"), max_width=IMAGE_FORMATS["jpg"])
+    finally:
+        scratch_filepath.unlink(missing_ok=True)
+
+
+@instrumented("input_header_filepath")
+def process_radargram(output_filepath: Path, input_header_filepath: Path, radar_key: str | None = None, encoding_profile: str = "archive", tiles: bool = False, single_pass: bool = False, n_bands: int = 1):
+    """Process one radargram, with steps defined from its filename/radar_key.
+
+    A JPG will be rendered beside the output_filepath.
+    If the data are longer than 60000 traces, the JPG will be split in parts.
+
+    Parameters
+    ----------
+    output_filepath
+        The output filepath to save the data in. If it ends with ".zarr", the data are saved as a
+        Zarr store chunked along the traces (rsgpr's netCDF output is converted). Otherwise, as netCDF.
+    input_header_filepath
+        The input .rad/.hd header filepath for the data to process.
+    radar_key
+        Optional. The radar_key to use for processing step determination.
+        If not provided, it will be determined from the filepath.
+    encoding_profile
+        The name of the encoding profile for rewritten data (see ENCODING_PROFILES).
+    tiles
+        Also generate a multi-resolution tile pyramid beside the output_filepath (see tiles.generate_tiles).
+    single_pass
+        Keep the rsgpr result in memory for the power correction and JPG rendering, instead of
+        rewriting and rereading the file for each step. The final file is then only written once.
+        This requires the whole radargram to fit in memory.
+    n_bands
+        The number of depth bands of the power variation correction (see fix_power_variation).
+    """
+    steps, run_fix_power_variation = processing_plan(input_header_filepath, radar_key=radar_key)
+    subset = subsetting(radar_key if radar_key is not None else input_header_filepath.stem)
+
     output_filepath.parent.mkdir(exist_ok=True, parents=True)
 
     print(f"Processing {input_header_filepath.name}")
-    run_rsgpr(input_filepath=input_header_filepath, output_filepath=output_filepath, steps=steps)
+    with tempfile.TemporaryDirectory(dir=output_filepath.parent) as temp_dir:
+        # Instead of letting rsgpr read the whole file and then subset it, only the subset is given to rsgpr
+        if subset is not None:
+            steps = [step for step in steps if not step.startswith("subset(")]
+            input_header_filepath = write_trace_subset(Path(temp_dir) / input_header_filepath.name, input_header_filepath, subset)
+
+        if single_pass:
+            _process_single_pass(output_filepath, input_header_filepath, steps, run_fix_power_variation, encoding_profile=encoding_profile, n_bands=n_bands)
+        elif output_filepath.suffix == ".zarr":
+            # rsgpr only writes netCDF, so its result is corrected as netCDF and then converted
+            netcdf_filepath = Path(temp_dir) / output_filepath.with_suffix(".nc").name
+            run_rsgpr(input_filepath=input_header_filepath, output_filepath=netcdf_filepath, steps=steps)
+
+            if run_fix_power_variation:
+                # The intermediate file is kept as float32, so the data are only packed once
+                fix_power_variation(netcdf_filepath, n_bands=n_bands, encoding_profile="fast")
+
+            convert_to_zarr(netcdf_filepath, output_filepath, encoding_profile=encoding_profile)
+            generate_jpgs(output_filepath, redo=True)
+        else:
+            run_rsgpr(input_filepath=input_header_filepath, output_filepath=output_filepath, steps=steps)
 
-    if run_fix_power_variation:
-        fix_power_variation(output_filepath)
+            if run_fix_power_variation:
+                fix_power_variation(output_filepath, n_bands=n_bands, encoding_profile=encoding_profile)
 
-    generate_jpgs(output_filepath, redo=True)
+            generate_jpgs(output_filepath, redo=True)
+
+    if tiles:
+        from tiles import generate_tiles
+        generate_tiles(output_filepath)
     
 
-def process_all_data(redo: bool = False):
+def _data_filepath(header_filepath: Path) -> Path:
+    """Get the filepath of the (largest) data file belonging to a .rad/.hd header."""
+    return header_filepath.with_suffix(".rd3" if header_filepath.suffix == ".rad" else ".dt1")
+
+
+def _estimate_memory(header_filepath: Path) -> int:
+    """Roughly estimate the peak memory in bytes needed to process one radargram.
+
+    The int16 data are expanded to floats in rsgpr and in the power variation correction,
+    which is assumed to take at most MEMORY_PER_DATA_BYTE times the size of the data file.
+    """
+    data_filepath = _data_filepath(header_filepath)
+    size = data_filepath.stat().st_size if data_filepath.is_file() else header_filepath.stat().st_size
+    return MEMORY_PER_DATA_BYTE * size
+
+
+def input_filepaths(header_filepath: Path) -> list[Path]:
+    """Get the header and data filepaths of a level1 radargram."""
+    suffixes = [".rad", ".rd3", ".cor"] if header_filepath.suffix == ".rad" else [".hd", ".dt1", ".gp2"]
+    return [filepath for suffix in suffixes if (filepath := header_filepath.with_suffix(suffix)).is_file()]
+
+
+def _file_hash(filepath: Path, manifest: dict) -> str:
+    """Get the SHA256 hash of a file.
+
+    Hashes are cached in the manifest and only recomputed if the file size or modification time changed.
+    """
+    stat = filepath.stat()
+    cached = manifest["file_hashes"].get(str(filepath.absolute()))
+    if cached is not None and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+        return cached["sha256"]
+
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as infile:
+        while chunk := infile.read(2 ** 24):
+            digest.update(chunk)
+
+    manifest["file_hashes"][str(filepath.absolute())] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+    return digest.hexdigest()
+
+
+def _rsgpr_version() -> str | None:
+    try:
+        import rsgpr
+    except ImportError:
+        return None
+    return str(rsgpr.version)
+
+
+def build_record(input_header_filepath: Path, manifest: dict, rsgpr_version: str | None = None, encoding_profile: str = "archive", n_bands: int = 1) -> dict:
+    """Describe everything that determines the level2 product of one radargram.
+
+    Parameters
+    ----------
+    input_header_filepath
+        The input .rad/.hd header filepath for the data to process.
+    manifest
+        The manifest to cache file hashes in.
+    rsgpr_version
+        The rsgpr version that will be used.
+    encoding_profile
+        The netCDF encoding profile that will be used. Only rsgpr writes the data if the
+        power correction isn't run, so the profile is only recorded for power corrected data.
+    n_bands
+        The number of depth bands of the power variation correction that will be used.
+
+    Returns
+    -------
+    A record that can be compared with the one stored in the manifest.
+    """
+    steps, run_fix_power_variation = processing_plan(input_header_filepath)
+    record = {
+        "inputs": {filepath.name: _file_hash(filepath, manifest) for filepath in input_filepaths(input_header_filepath)},
+        "steps": steps,
+        "rsgpr_version": rsgpr_version,
+        "power_fixed": run_fix_power_variation,
+        "encoding_profile": encoding_profile if run_fix_power_variation else None,
+    }
+
+    # process_radargram replaces the subset step with a subset copy of the input (see write_trace_subset).
+    # It's only recorded for subset radargrams, so the records of the others stay the same.
+    if (subset := subsetting(input_header_filepath.stem)) is not None:
+        record["pre_subset"] = {"range": list(subset), "version": PRE_SUBSET_VERSION}
+
+    # Likewise, the depth bands are only recorded if they differ from the original single band
+    if run_fix_power_variation and n_bands != 1:
+        record["power_bands"] = n_bands
+
+    return record
+
+
+def load_manifest(filepath: Path) -> dict:
+    """Load a level2 build manifest, or create an empty one if it doesn't exist."""
+    if filepath.is_file():
+        return json.loads(filepath.read_text())
+    return {"file_hashes": {}, "products": {}}
+
+
+def save_manifest(filepath: Path, manifest: dict):
+    """Save a level2 build manifest. The file is replaced atomically to survive interruptions."""
+    filepath.parent.mkdir(exist_ok=True, parents=True)
+    tmp_path = filepath.with_name(filepath.name + ".tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=1))
+    os.replace(tmp_path, filepath)
+
+
+def _process_radargram_task(output_filepath: Path, input_header_filepath: Path, **kwargs) -> str | None:
+    """Process one radargram in a worker process, returning the error message if it failed."""
+    try:
+        process_radargram(output_filepath=output_filepath, input_header_filepath=input_header_filepath, **kwargs)
+    except RuntimeError as exception:
+        return str(exception)
+    return None
+
+
+def _run_parallel(tasks: list[tuple[Path, Path]], jobs: int, memory_budget: float, on_success: Callable[[Path, Path], None] | None = None, **kwargs) -> dict[Path, str]:
+    """Process radargrams on a process pool, largest first, within a memory budget.
+
+    Parameters
+    ----------
+    tasks
+        Pairs of (output_filepath, input_header_filepath) to process.
+    jobs
+        The maximum number of simultaneous processes.
+    memory_budget
+        The maximum summed estimated memory (in bytes) of the running processes.
+        At least one radargram is always processed, even if it exceeds the budget.
+    on_success
+        Optional. A function to call with (output_filepath, input_header_filepath) for each finished radargram.
+    kwargs
+        Keyword arguments to give to process_radargram.
+
+    Returns
+    -------
+    The error messages of each failed input header filepath.
+    """
+    import concurrent.futures
+
+    pending = sorted(tasks, key=lambda task: _estimate_memory(task[1]), reverse=True)
+    running = {}
+    failures = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            # Submit the largest tasks that fit in the remaining budget
+            used_memory = sum(memory for _, memory in running.values())
+            for task in list(pending):
+                if len(running) >= jobs:
+                    break
+                memory = _estimate_memory(task[1])
+                if running and (used_memory + memory) > memory_budget:
+                    continue
+                pending.remove(task)
+                running[executor.submit(_process_radargram_task, *task, **kwargs)] = (task, memory)
+                used_memory += memory
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                (output_filepath, header_filepath), _ = running.pop(future)
+                if (error := future.result()) is not None:
+                    print(f"Failed on {header_filepath.name} with error: {error}")
+                    failures[header_filepath] = error
+                elif on_success is not None:
+                    on_success(output_filepath, header_filepath)
+
+    return failures
+
+
+def process_all_data(redo: bool = False, jobs: int = 1, memory_budget_gb: float | None = None, encoding_profile: str = "archive", tiles: bool = False, single_pass: bool = False, output_format: str = "netcdf", n_bands: int = 1):
     """Process (level2) GPR data using rsgpr.
 
+    A manifest in the level2 directory records the input file hashes, processing steps,
+    rsgpr version and power correction of every product. Only products whose record
+    changed (or that don't exist) are rebuilt.
+
     Parameters
     ----------
     redo
-        Reprocess data despite already existing.
+        Reprocess data despite already existing and being up to date.
+    jobs
+        The number of radargrams to process in parallel. If larger than 1, a process pool is used.
+    memory_budget_gb
+        Optional. The memory budget in GB for parallel processing. Defaults to 75% of the available
+        memory if psutil is installed, and no limit otherwise.
+    encoding_profile
+        The name of the netCDF encoding profile for rewritten data (see ENCODING_PROFILES).
+    tiles
+        Also generate multi-resolution tile pyramids of the processed radargrams.
+    single_pass
+        Keep each rsgpr result in memory for the following steps, so it's only written once (see process_radargram).
+    output_format
+        The format of the level2 data. One of OUTPUT_FORMATS.
+    n_bands
+        The number of depth bands of the power variation correction (see fix_power_variation).
     """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}. Choices: {list(OUTPUT_FORMATS)}")
+
     level1_dir = Path("processed/level1")
     level2_dir = Path("processed/level2")
+    manifest_filepath = level2_dir / "manifest.json"
+
+    manifest = load_manifest(manifest_filepath)
+    rsgpr_version = _rsgpr_version()
 
-    for header_filepath in level1_dir.rglob("*.*"):
+    # The catalog finds the level1 headers that conform to the naming convention
+    from catalog import update_catalog, find_profiles
+    update_catalog(level1_dir=level1_dir, level2_dir=level2_dir)
 
-        if header_filepath.suffix not in [".hd", ".rad"]:
-            continue
-        # Skip any filepath that doesn't conform to the naming convention
-        if not len(header_filepath.stem.split("-")) == 6:
-            print(f"Found {header_filepath} but its name was unexpected")
-            continue
+    tasks = []
+    records = {}
+    for header_filepath in map(Path, find_profiles()["level1_filepath"]):
 
         # Complicated way to retain the file structure but now in level2
         # E.g. some_dir/level1/subdir/file.rad -> new_dir/level2/subdir/file.rad
-        output_filepath = (level2_dir / "/".join(header_filepath.parts[slice(header_filepath.parts.index("level1") + 1, None)])).with_suffix(".nc")
+        output_filepath = (level2_dir / "/".join(header_filepath.parts[slice(header_filepath.parts.index("level1") + 1, None)])).with_suffix(OUTPUT_FORMATS[output_format])
+
+        product_key = output_filepath.relative_to(level2_dir).as_posix()
+        records[header_filepath] = build_record(header_filepath, manifest, rsgpr_version=rsgpr_version, encoding_profile=encoding_profile, n_bands=n_bands)
+
+        if not output_filepath.exists() or redo or manifest["products"].get(product_key) != records[header_filepath]:
+            tasks.append((output_filepath, header_filepath))
 
-        if "austfonna-profile-2024-25MHz" in output_filepath.stem:
-            redo = True
+    # Save the file hashes now so they don't need to be recomputed if the run is interrupted
+    save_manifest(manifest_filepath, manifest)
+    print(f"{len(tasks)}/{len(records)} radargrams need to be processed")
+
+    def on_success(output_filepath: Path, header_filepath: Path):
+        manifest["products"][output_filepath.relative_to(level2_dir).as_posix()] = records[header_filepath]
+        save_manifest(manifest_filepath, manifest)
+
+    if jobs > 1:
+        if memory_budget_gb is not None:
+            memory_budget = memory_budget_gb * 1e9
         else:
-            continue
+            try:
+                import psutil
+                memory_budget = 0.75 * psutil.virtual_memory().available
+            except ImportError:
+                memory_budget = np.inf
+        failures = _run_parallel(tasks, jobs=jobs, memory_budget=memory_budget, on_success=on_success, encoding_profile=encoding_profile, tiles=tiles, single_pass=single_pass, n_bands=n_bands)
+    else:
+        failures = {}
+        for output_filepath, header_filepath in tasks:
+            if (error := _process_radargram_task(output_filepath, header_filepath, encoding_profile=encoding_profile, tiles=tiles, single_pass=single_pass, n_bands=n_bands)) is not None:
+                print(f"Failed with error: {error}")
+                failures[header_filepath] = error
+            else:
+                on_success(output_filepath, header_filepath)
+
+    update_catalog(level1_dir=level1_dir, level2_dir=level2_dir)
 
-        try:
-            if not output_filepath.is_file() or redo:
-                process_radargram(output_filepath=output_filepath, input_header_filepath=header_filepath)
-        except RuntimeError as exception:
-            print(f"Failed with error: {exception}")
+    if len(failures) > 0:
+        print(f"{len(failures)}/{len(tasks)} radargrams failed:")
+        for header_filepath, error in failures.items():
+            print(f"  {header_filepath}: {error}")
 
 
 if __name__ == "__main__":
-    process_all_data()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Process (level2) GPR data using rsgpr.")
+    parser.add_argument("--redo", action="store_true", help="Reprocess data despite already existing and being up to date.")
+    parser.add_argument("--jobs", type=int, default=1, help="The number of radargrams to process in parallel.")
+    parser.add_argument("--memory-gb", type=float, default=None, help="The memory budget for parallel processing.")
+    parser.add_argument("--encoding", choices=list(ENCODING_PROFILES), default="archive", help="The encoding profile for rewritten data.")
+    parser.add_argument("--format", choices=list(OUTPUT_FORMATS), default="netcdf", help="The format of the level2 data.")
+    parser.add_argument("--tiles", action="store_true", help="Also generate multi-resolution tile pyramids.")
+    parser.add_argument("--single-pass", action="store_true", help="Only write each radargram once, keeping it in memory between the steps.")
+    parser.add_argument("--power-bands", type=int, default=1, help="The number of depth bands of the power variation correction.")
+    args = parser.parse_args()
+
+    # Every stage is timed and recorded in a run report, which is summarized at the end
+    with run_report(report_filepath(Path("processed/reports"), "level2")):
+        process_all_data(redo=args.redo, jobs=args.jobs, memory_budget_gb=args.memory_gb, encoding_profile=args.encoding, tiles=args.tiles, single_pass=args.single_pass, output_format=args.format, n_bands=args.power_bands)
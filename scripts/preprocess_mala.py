@@ -5,17 +5,195 @@ import matplotlib.pyplot as plt
 
 from pathlib import Path
 from dataclasses import dataclass
+from typing import Callable
+import hashlib
+import os
 import warnings
 
+from instrumentation import instrumented
+
+# The default number of traces to handle at once when working on the data in chunks
+CHUNK_TRACES = 8192
+
+# Times are represented as seconds since this date. This is used for synchronization
+TIME_EPOCH = np.datetime64("2000-01-01", "s")
+
+# The time offset in seconds between the external GPS tracks and the corfiles
+GPS_TIME_OFFSET = 18
+
+# Where parsed corfiles are cached, relative to the processed data directory. The cache is opt-in (see read_cor)
+COR_CACHE_DIR = Path("cache/cor")
+
+# Where parsed external GPS tracks are cached
+GPS_TRACK_CACHE_DIR = Path("processed/cache/gps")
+
 
 @dataclass
 class GPR:
-    """Convenience container for the three essential Ramac files."""
+    """Convenience container for the three essential Ramac (or pulseEKKO) files.
+
+    The rd3 array has the shape (samples, traces). It may be a view of a np.memmap,
+    in which case the data are only read from disk when they are accessed.
+
+    pulseEKKO data (see pulseekko.load_pulseekko) have the .hd header as the rad, the .gp2 GPS file
+    as the cor, and also have the (traces, 32) trace headers of the .dt1 file.
+    """
     rd3: np.ndarray
     rad: dict[str, str]
     cor: pd.DataFrame
+    trace_headers: np.ndarray | None = None
+
+    @property
+    def n_traces(self) -> int:
+        return self.rd3.shape[1]
+
+    def read_traces(self, start: int, end: int | None = None) -> np.ndarray:
+        """Read a range of traces into memory as a (samples, traces) array."""
+        return np.array(self.rd3[:, start:end])
+
+    def iter_trace_chunks(self, chunk_size: int = CHUNK_TRACES):
+        """Iterate over the radargram in blocks of traces.
+
+        Yields
+        ------
+        The first trace index of the block and the (samples, traces) block in memory.
+        """
+        for start in range(0, self.n_traces, chunk_size):
+            yield start, self.read_traces(start, start + chunk_size)
+
+
+def _parse_cor(cor_filepath: Path) -> pd.DataFrame:
+    """Parse a corfile into typed columns, and add a "time" column in seconds since TIME_EPOCH."""
+    cor = pd.read_csv(cor_filepath, sep="\t", header=None, dtype={0: "int64", 1: str, 2: str, 3: "float64", 5: "float64", 7: "float64"})
+
+    try:
+        dates = cor[1].to_numpy().astype("datetime64[D]")
+        cor["time"] = (dates - TIME_EPOCH).astype("float64") + pd.to_timedelta(cor[2]).dt.total_seconds().to_numpy()
+    except (ValueError, KeyError) as exception:
+        warnings.warn(f"Could not parse the times of {cor_filepath}: {exception}")
+        cor["time"] = np.nan
+
+    return cor
+
+
+def read_cor(cor_filepath: Path, cache_dir: Path | None = None) -> pd.DataFrame:
+    """Read a Ramac corfile.
+
+    The columns keep their position in the file as labels (0: trace number, 1: date, 2: time,
+    3: latitude, 5: longitude, 7: height), and a "time" column in seconds since TIME_EPOCH is added.
+
+    Parameters
+    ----------
+    cor_filepath
+        The filepath to the cor file.
+    cache_dir
+        Optional. A directory to cache the parsed corfile in, e.g. COR_CACHE_DIR in the processed data directory.
+        The cache is invalidated if the size or modification time of the corfile changes. If None, no cache is used.
+
+    Returns
+    -------
+    A table of the coordinates.
+    """
+    if cache_dir is None:
+        return _parse_cor(cor_filepath)
+
+    stat = cor_filepath.stat()
+    path_hash = hashlib.sha1(str(cor_filepath.absolute()).encode()).hexdigest()[:16]
+    cache_filepath = cache_dir / f"{cor_filepath.stem}-{path_hash}.npz"
+
+    if cache_filepath.is_file():
+        with np.load(cache_filepath, allow_pickle=False) as cache:
+            if cache["size"] == stat.st_size and cache["mtime_ns"] == stat.st_mtime_ns:
+                return pd.DataFrame({(int(key) if key.isdigit() else str(key)): cache[key] for key in cache["columns"]})
+
+    cor = _parse_cor(cor_filepath)
+
+    cache_dir.mkdir(exist_ok=True, parents=True)
+    # Text columns are stored as fixed-width strings so the cache can be read without pickle
+    columns = {}
+    for col in cor.columns:
+        if pd.api.types.is_numeric_dtype(cor[col]):
+            columns[str(col)] = cor[col].to_numpy()
+        else:
+            columns[str(col)] = cor[col].fillna("").to_numpy().astype(str)
+    tmp_path = cache_filepath.with_name(cache_filepath.name + ".tmp")
+    with open(tmp_path, "wb") as outfile:
+        np.savez(outfile, size=stat.st_size, mtime_ns=stat.st_mtime_ns, columns=np.array(list(columns)), **columns)
+    os.replace(tmp_path, cache_filepath)
+
+    return cor
+
+
+def resolve_trace_range(trace_range: tuple[int, int], n_traces: int) -> tuple[int, int]:
+    """Convert a (start, end) trace range to the (start, stop) indices of a slice of traces.
 
-def load_ramac(rad_filepath: Path, rd3_filepath: Path | None = None, cor_filepath: Path | None = None) -> GPR:
+    Like in the rsgpr subset step (and subsetting()), the start and end are both inclusive, and an end of -1
+    means the last trace. rsgpr documents subset(0 499) as clipping the data to the first 500 traces.
+    """
+    start, end = trace_range
+    stop = n_traces if end < 0 else min(end + 1, n_traces)
+    start = min(max(start, 0), stop)
+    return start, stop
+
+
+def subset_coordinates(coords: pd.DataFrame, start: int, stop: int, interpolate: list | None = None) -> pd.DataFrame:
+    """Keep the coordinates of a slice of traces, and shift their (1-based) trace counters to the new positions.
+
+    The coordinates of the traces between two fixes are interpolated by trace number, so the fixes
+    just outside of the slice are needed for the first and last traces to get the same positions as before.
+
+    Parameters
+    ----------
+    coords
+        The coordinates, with the 1-based trace counter in column 0.
+    start
+        The index of the first trace to keep.
+    stop
+        The index after the last trace to keep.
+    interpolate
+        Optional. Numeric columns to interpolate at the first and last trace of the slice, if they lie between
+        two fixes. The other columns are copied from the nearest fix. If not given, the nearest fix on each side
+        of the slice is kept instead, with a trace counter outside of the new range (below 1 or above stop - start).
+
+    Returns
+    -------
+    The coordinates of the slice.
+    """
+    traces = coords[0].to_numpy()
+    inside = (traces > start) & (traces <= stop)
+    before = np.flatnonzero(traces <= start)
+    after = np.flatnonzero(traces > stop)
+
+    parts = [coords.loc[inside]]
+    if interpolate is None:
+        if before.size > 0:
+            parts.insert(0, coords.iloc[[before[np.argmax(traces[before])]]])
+        if after.size > 0:
+            parts.append(coords.iloc[[after[np.argmin(traces[after])]]])
+    else:
+        for target in ([start + 1, stop] if stop > start else []):
+            if np.any(traces == target):
+                continue
+            lower = np.flatnonzero(traces < target)
+            upper = np.flatnonzero(traces > target)
+            if lower.size == 0 or upper.size == 0:
+                continue
+            lower = lower[np.argmax(traces[lower])]
+            upper = upper[np.argmin(traces[upper])]
+
+            weight = (target - traces[lower]) / (traces[upper] - traces[lower])
+            row = coords.iloc[[lower if weight < 0.5 else upper]].copy()
+            for column in interpolate:
+                row[column] = coords[column].iloc[lower] + weight * (coords[column].iloc[upper] - coords[column].iloc[lower])
+            row[0] = target
+            parts.append(row)
+
+    coords = pd.concat(parts).sort_values(0, kind="stable") if len(parts) > 1 else parts[0].copy()
+    coords[0] -= start
+    return coords
+
+
+def load_ramac(rad_filepath: Path, rd3_filepath: Path | None = None, cor_filepath: Path | None = None, mmap: bool = False, trace_range: tuple[int, int] | None = None, cor_cache_dir: Path | None = None) -> GPR:
     """Load a Malå Ramac file into memory.
 
     Parameters
@@ -26,6 +204,14 @@ def load_ramac(rad_filepath: Path, rd3_filepath: Path | None = None, cor_filepat
         Optional. The filepath to the rd3 file. If not given, it's assumed to lie beside the ".rad" file.
     cor_filepath
         Optional. The filepath to the cor file. If not given, it's assumed to lie beside the ".rad" file.
+    mmap
+        Memory-map the rd3 file instead of reading it. Traces are then only read when accessed.
+    trace_range
+        Optional. Only load the inclusive (start, end) range of traces (see resolve_trace_range). Only that part of
+        the rd3 file is read. The corfile is subset to match, with positions interpolated at the first and last trace
+        (see subset_coordinates).
+    cor_cache_dir
+        Optional. A directory to cache the parsed corfile in (see read_cor). If None, no cache is used.
 
     Returns
     -------
@@ -46,20 +232,54 @@ def load_ramac(rad_filepath: Path, rd3_filepath: Path | None = None, cor_filepat
         rad[key.strip()] = value.strip()
 
     # Read the cor (coordinate) file
-    cor = pd.read_csv(cor_filepath, sep="\t", header=None)
+    cor = read_cor(cor_filepath, cache_dir=cor_cache_dir)
 
     # Read the rd3 (radargram) file
-    rd3 = np.fromfile(rd3_filepath, dtype="<i2").reshape((-1, int(rad["SAMPLES"]))).T
+    n_samples = int(rad["SAMPLES"])
+    n_traces = rd3_filepath.stat().st_size // (2 * n_samples)
+    start, end = 0, n_traces
+    if trace_range is not None:
+        start, end = resolve_trace_range(trace_range, n_traces)
+        cor = subset_coordinates(cor, start, end, interpolate=[3, 5, 7, "time"])
+        rad["LAST TRACE"] = str(end - start)
+
+    # Only the requested traces are read, by starting at their byte offset
+    offset = start * 2 * n_samples
+    if mmap:
+        if end > start:
+            rd3 = np.memmap(rd3_filepath, dtype="<i2", mode="r", offset=offset, shape=(end - start, n_samples)).T
+        else:
+            rd3 = np.empty((n_samples, 0), dtype="<i2")
+    else:
+        rd3 = np.fromfile(rd3_filepath, dtype="<i2", offset=offset, count=(end - start) * n_samples).reshape((-1, n_samples)).T
 
     return GPR(rd3, rad, cor)
+
+
+def find_nonempty_traces(gpr: GPR, chunk_size: int = CHUNK_TRACES) -> np.ndarray:
+    """Get a boolean mask of the traces that contain any data.
+
+    The traces are checked in chunks, so a memory-mapped radargram is never fully loaded.
+    Checking for nonzero values (instead of summing absolute values) avoids int16 overflow.
+    """
+    nonempty = np.empty(gpr.n_traces, dtype=bool)
+    for start, block in gpr.iter_trace_chunks(chunk_size):
+        nonempty[start:start + block.shape[1]] = np.any(block != 0, axis=0)
+
+    return nonempty
+
     
 def remove_empty_traces(gpr: GPR) -> GPR:
     """Remove any trace without data (sum=0).
 
     This also removes any coordinate associated with that trace.
+
+    The empty traces are found chunk by chunk, but the returned radargram is in memory, even if the
+    input is memory-mapped. To remove empty traces from files with bounded memory (as the preprocessing
+    does), use stream_remove_empty_traces instead.
     """
     # Find which indices to keep (which are not empty traces)
-    keep = np.argwhere(np.sum(np.abs(gpr.rd3), axis=0) > 0).ravel()
+    keep = np.flatnonzero(find_nonempty_traces(gpr))
 
     if keep.size == gpr.rd3.shape[1]:
         return gpr
@@ -80,9 +300,16 @@ def remove_empty_traces(gpr: GPR) -> GPR:
     print(f"Removed {n_removed} empty traces")
 
     rad = gpr.rad.copy()
-    rad["LAST TRACE"] = str(rd3.shape[1])
+    trace_headers = None
+    if gpr.trace_headers is not None:
+        # pulseEKKO data
+        trace_headers = gpr.trace_headers[keep]
+        trace_headers[:, 0] = np.arange(1, keep.size + 1)
+        rad["NUMBER OF TRACES"] = str(rd3.shape[1])
+    else:
+        rad["LAST TRACE"] = str(rd3.shape[1])
 
-    return GPR(rd3=rd3, rad=rad, cor=cor)
+    return GPR(rd3=rd3, rad=rad, cor=cor, trace_headers=trace_headers)
 
 
 
@@ -102,65 +329,326 @@ def save_ramac(output_rad_filepath: Path, gpr: GPR) -> None:
     rad_text = "\n".join([f"{key}: {value}" for key, value in gpr.rad.items()])
     output_rad_filepath.write_text(rad_text)
 
-    gpr.cor.to_csv(cor_filepath, sep="\t", header=False, index=False)
+    gpr.cor.drop(columns="time", errors="ignore").to_csv(cor_filepath, sep="\t", header=False, index=False)
 
-    gpr.rd3.astype("int16").T.ravel().tofile(rd3_filepath, format="<i2")
+    # Write the rd3 in chunks to avoid making full copies of the (possibly memory-mapped) data
+    with open(rd3_filepath, "wb") as outfile:
+        for _, block in gpr.iter_trace_chunks():
+            np.ascontiguousarray(block.T, dtype="<i2").tofile(outfile)
 
 
-def replace_gps_track(gpr: GPR, gps_filepath: Path):
-    """Replace the coordinate information of the corfile with an external track.
+def stream_nonempty_traces(
+    infile,
+    outfile,
+    dtype: np.dtype,
+    coords: pd.DataFrame,
+    write_coords: Callable[[pd.DataFrame], None],
+    samples: Callable[[np.ndarray], np.ndarray] | None = None,
+    renumber: Callable[[np.ndarray, int], None] | None = None,
+    chunk_size: int = CHUNK_TRACES,
+) -> tuple[int, int]:
+    """Copy the nonempty traces of a binary trace file and their coordinates, one block of traces at a time.
 
-    The function assumes that the track and corfile times are synchronized.
+    This is shared by the Ramac (see stream_remove_empty_traces) and pulseEKKO (see pulseekko.stream_remove_empty_traces)
+    empty trace removal. The memory usage is independent of the file length. The coordinates keep their
+    position in the data (column 0, 1-based) and are renumbered to match the new trace positions.
+
+    Parameters
+    ----------
+    infile
+        The binary file to read the traces from.
+    outfile
+        The binary file to write the nonempty traces to.
+    dtype
+        The dtype of one trace record in the file.
+    coords
+        The coordinates of the input data, with the 1-based trace number in column 0.
+    write_coords
+        A function that writes one block of renumbered coordinates.
+    samples
+        Optional. A function that gets the (traces, samples) samples of a block of records. Defaults to the records themselves.
+    renumber
+        Optional. A function that renumbers a block of kept records in place, given the number of previously kept traces.
+    chunk_size
+        The number of traces to read at a time.
+
+    Returns
+    -------
+    The number of read and kept traces.
+    """
+    # The trace counter is used to find the coordinates of each block
+    if not coords[0].is_monotonic_increasing:
+        coords = coords.sort_values(0, kind="stable")
+    coord_traces = coords[0].to_numpy()
+
+    n_read = 0
+    n_kept = 0
+    while len(records := np.fromfile(infile, dtype=dtype, count=chunk_size)) > 0:
+        keep = np.any((records if samples is None else samples(records)) != 0, axis=1)
+
+        kept = records[keep]
+        if renumber is not None:
+            renumber(kept, n_kept)
+        kept.tofile(outfile)
+
+        # Find the coordinates within the block and shift their counters to the new positions
+        lower = np.searchsorted(coord_traces, n_read + 1, side="left")
+        upper = np.searchsorted(coord_traces, n_read + len(records), side="right")
+        block_coord_idx = coord_traces[lower:upper] - n_read - 1
+        coord_keep = keep[block_coord_idx]
+        coord_block = coords.iloc[lower:upper].loc[coord_keep].copy()
+        coord_block[0] = n_kept + np.cumsum(keep)[block_coord_idx[coord_keep]]
+        write_coords(coord_block)
+
+        n_read += len(records)
+        n_kept += len(kept)
+
+    return n_read, n_kept
+
+
+def stream_remove_empty_traces(output_rad_filepath: Path, input_rd3_filepath: Path, rad: dict[str, str], cor: pd.DataFrame, chunk_size: int = CHUNK_TRACES) -> int:
+    """Remove empty traces while streaming an rd3 file into a new Ramac file.
+
+    The rd3 is read and written in blocks of traces, and the corfile is re-indexed
+    block by block, so the memory usage is independent of the file length (see stream_nonempty_traces).
+
+    Parameters
+    ----------
+    output_rad_filepath
+        The output filepath of the corrected data. Must end with ".rad". Other files are saved beside it.
+    input_rd3_filepath
+        The filepath to the rd3 file to read.
+    rad
+        The header of the input data.
+    cor
+        The coordinates of the input data.
+    chunk_size
+        The number of traces to read at a time.
+
+    Returns
+    -------
+    The number of removed traces.
+    """
+    if output_rad_filepath.suffix != ".rad":
+        raise ValueError("The output rad file must have a '.rad' suffix")
+    # One record per trace, with the shape (traces, samples) like on disk
+    dtype = np.dtype(("<i2", (int(rad["SAMPLES"]),)))
+
+    with (
+        open(input_rd3_filepath, "rb") as rd3_infile,
+        open(output_rad_filepath.with_suffix(".rd3"), "wb") as rd3_outfile,
+        open(output_rad_filepath.with_suffix(".cor"), "w", newline="") as cor_outfile,
+    ):
+        n_read, n_kept = stream_nonempty_traces(
+            rd3_infile,
+            rd3_outfile,
+            dtype=dtype,
+            coords=cor,
+            write_coords=lambda cor_block: cor_block.drop(columns="time", errors="ignore").to_csv(cor_outfile, sep="\t", header=False, index=False),
+            chunk_size=chunk_size,
+        )
+
+    n_removed = n_read - n_kept
+    if n_removed > 0:
+        print(f"Removed {n_removed} empty traces")
+        rad = rad.copy()
+        rad["LAST TRACE"] = str(n_kept)
+
+    rad_text = "\n".join([f"{key}: {value}" for key, value in rad.items()])
+    output_rad_filepath.write_text(rad_text)
+
+    return n_removed
+
+
+@dataclass
+class GPSTrack:
+    """An external GPS track, sorted by time."""
+    time: np.ndarray
+    """Seconds since TIME_EPOCH, with the GPS time offset applied."""
+    coords: np.ndarray
+    """The (time, 3) longitude, latitude and height of each position."""
+    crs: str | None = None
+    """The projected CRS of the original track, used for validation."""
+
+    def interpolate(self, times: np.ndarray) -> np.ndarray:
+        """Linearly interpolate the (time, 3) coordinates at the given times.
+
+        Raises
+        ------
+        ValueError
+            If any time is outside the time range of the track.
+        """
+        if times.min() < self.time[0] or times.max() > self.time[-1]:
+            raise ValueError(f"Times ({times.min()}-{times.max()}) are out of the track's time range ({self.time[0]}-{self.time[-1]})")
+
+        idx = np.clip(np.searchsorted(self.time, times, side="right") - 1, 0, self.time.size - 2)
+        weights = ((times - self.time[idx]) / (self.time[idx + 1] - self.time[idx]))[:, None]
+        return self.coords[idx] + (self.coords[idx + 1] - self.coords[idx]) * weights
+
+    def window(self, start: float, end: float) -> "GPSTrack":
+        """Get the part of the track between two times, including the positions just outside for interpolation."""
+        lower = max(np.searchsorted(self.time, start, side="right") - 1, 0)
+        upper = min(np.searchsorted(self.time, end, side="left") + 1, self.time.size)
+        return GPSTrack(time=self.time[lower:upper], coords=self.coords[lower:upper], crs=self.crs)
+
+
+def _track_times(yyyymmdd: np.ndarray, hhmmss: np.ndarray) -> np.ndarray:
+    """Convert integer-like yyyymmdd and HHMMSS columns to seconds since TIME_EPOCH."""
+    ymd = np.asarray(yyyymmdd).astype(np.int64)
+    hms = np.asarray(hhmmss).astype(np.int64)
+
+    months = (ymd // 10000 - 1970).astype("datetime64[Y]") + (ymd // 100 % 100 - 1).astype("timedelta64[M]")
+    dates = months.astype("datetime64[D]") + (ymd % 100 - 1).astype("timedelta64[D]")
+
+    return (dates - TIME_EPOCH).astype("float64") + (hms // 10000) * 3600 + (hms // 100 % 100) * 60 + hms % 100
+
+
+def read_gps_track(gps_filepath: Path) -> GPSTrack:
+    """Read an external GPS track.
 
     Only a specific track format is supported (used by the Austfonna field campaigns)
     """
     import geopandas as gpd
-    import scipy.interpolate
 
     track = gpd.read_file(gps_filepath)
-    # Convert the date to seconds since 2000. This is used for synchronization
-    track["time"] = (pd.to_datetime(track["yyyymmdd"].astype(str) + track["HHMMSS"].astype(str), format="%Y%m%d%H%M%S") - pd.Timestamp("2000-01-01")).dt.total_seconds()
-    # Adjust the GPS time offset 
-    track["time"] -= 18
+    time = _track_times(track["yyyymmdd"], track["HHMMSS"])
+    # Adjust the GPS time offset
+    time -= GPS_TIME_OFFSET
 
-    coords = gpr.cor.copy()
-    # Convert the date to seconds since 2000. This is used for synchronization
-    coords["time"] = (pd.to_datetime(coords[1] + coords[2], format="%Y-%m-%d%H:%M:%S") - pd.Timestamp("2000-01-01")).dt.total_seconds()
+    coords = np.column_stack([track["Longitude"], track["Latitude"], track["h_wgs"]]).astype("float64")
 
-    if track["time"].max() < coords["time"].min() or track["time"].min() > coords["time"].max():
-        warnings.warn("Track and corfile do not align in time. Continuing without correction.")
-        return gpr
+    # Interpolation needs increasing times, so this is checked once here
+    if np.any(np.diff(time) < 0):
+        order = np.argsort(time, kind="stable")
+        time = time[order]
+        coords = coords[order]
+
+    return GPSTrack(time=time, coords=coords, crs=track.crs.to_string() if track.crs is not None else None)
+
+
+class GPSTrackStore:
+    """Load external GPS tracks once and share them between every line that needs them.
 
-    # All this block is only for validation.
-    # This will convert to m coordinates, compare the two GPSes, and print the result.
-    coords = gpd.GeoDataFrame(coords, geometry=gpd.points_from_xy(coords[5], coords[3], crs=4326)).to_crs(track.crs)
+    Parsed tracks are kept in memory, and cached on disk with the hash of the track file as the key,
+    so a track is only parsed again if its contents change.
+    """
+
+    def __init__(self, cache_dir: Path | None = GPS_TRACK_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._tracks: dict[tuple[str, int, int], GPSTrack] = {}
+
+    def get(self, gps_filepath: Path) -> GPSTrack:
+        """Get the whole track of a track file."""
+        stat = gps_filepath.stat()
+        key = (str(gps_filepath.absolute()), stat.st_size, stat.st_mtime_ns)
+
+        if key not in self._tracks:
+            self._tracks[key] = self._load(gps_filepath)
+        return self._tracks[key]
+
+    def window(self, gps_filepath: Path, start: float, end: float) -> GPSTrack:
+        """Get the part of a track between two times (in seconds since TIME_EPOCH)."""
+        return self.get(gps_filepath).window(start, end)
+
+    def _load(self, gps_filepath: Path) -> GPSTrack:
+        if self.cache_dir is None:
+            return read_gps_track(gps_filepath)
+
+        file_hash = hashlib.sha256()
+        with open(gps_filepath, "rb") as infile:
+            while chunk := infile.read(2 ** 20):
+                file_hash.update(chunk)
+        cache_filepath = self.cache_dir / f"{gps_filepath.stem}-{file_hash.hexdigest()[:16]}.npz"
+
+        if cache_filepath.is_file():
+            with np.load(cache_filepath, allow_pickle=False) as cache:
+                return GPSTrack(time=cache["time"], coords=cache["coords"], crs=str(cache["crs"]) or None)
+
+        track = read_gps_track(gps_filepath)
+
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+        tmp_path = cache_filepath.with_name(cache_filepath.name + ".tmp")
+        with open(tmp_path, "wb") as outfile:
+            np.savez(outfile, time=track.time, coords=track.coords, crs=track.crs or "")
+        os.replace(tmp_path, cache_filepath)
+
+        return track
+
+
+# The tracks are shared by all calls in the same process
+GPS_TRACKS = GPSTrackStore()
+
+
+def _print_track_deviation(cor: pd.DataFrame, track: GPSTrack, new_coords: np.ndarray):
+    """Print the standard deviation in m between the corfile positions and the new positions."""
+    import geopandas as gpd
+
+    old_points = gpd.points_from_xy(cor[5], cor[3], crs=4326).to_crs(track.crs)
+    new_points = gpd.points_from_xy(new_coords[:, 0], new_coords[:, 1], crs=4326).to_crs(track.crs)
     for coord in ["x", "y"]:
-        model = scipy.interpolate.interp1d(track["time"], getattr(track.geometry, coord))
-        new_coords = model(coords["time"])
-        coord_std = (getattr(coords.geometry, coord) - new_coords).std()
+        coord_std = (getattr(old_points, coord) - getattr(new_points, coord)).std()
         print(f"Correcting track with an {coord} stdev of {coord_std:.2f} m")
 
 
-    # Interpolate the track's coordinates to the corfile's times
-    coords[5] = scipy.interpolate.interp1d(track["time"], track["Longitude"])(coords["time"])
-    coords[3] = scipy.interpolate.interp1d(track["time"], track["Latitude"])(coords["time"])
-    coords[7] = scipy.interpolate.interp1d(track["time"], track["h_wgs"])(coords["time"])
+def replace_gps_track(gpr: GPR, gps_filepath: Path, validate: bool = False, store: GPSTrackStore | None = None):
+    """Replace the coordinate information of the corfile with an external track.
 
-    return GPR(gpr.rd3, gpr.rad, coords[gpr.cor.columns])
+    The function assumes that the track and corfile times are synchronized.
 
+    Only a specific track format is supported (used by the Austfonna field campaigns)
 
+    Parameters
+    ----------
+    gpr
+        The data to replace the coordinates of.
+    gps_filepath
+        The filepath to the external track.
+    validate
+        Print how much the coordinates change, in m. This requires reprojecting the coordinates and is slow.
+    store
+        Optional. The store to load the track from. Defaults to the shared GPS_TRACKS.
+    """
+    track = (store if store is not None else GPS_TRACKS).get(gps_filepath)
+
+    # The corfile times are already in seconds since 2000 (see read_cor)
+    times = gpr.cor["time"].to_numpy()
+
+    if track.time[-1] < times.min() or track.time[0] > times.max():
+        warnings.warn("Track and corfile do not align in time. Continuing without correction.")
+        return gpr
+
+    # Interpolate all of the track's coordinates to the corfile's times at once
+    track = track.window(times.min(), times.max())
+    new_coords = track.interpolate(times)
+
+    if validate:
+        _print_track_deviation(gpr.cor, track, new_coords)
+
+    coords = gpr.cor.copy()
+    coords[5] = new_coords[:, 0]
+    coords[3] = new_coords[:, 1]
+    coords[7] = new_coords[:, 2]
+
+    return GPR(gpr.rd3, gpr.rad, coords)
+
+
+@instrumented("input_rad_filepath")
 def preprocess_mala(
     output_rad_filepath: Path,
     input_rad_filepath: Path,
     input_rd3_filepath: Path | None = None,
     input_cor_filepath: Path | None = None,
-    better_gps_path: Path | None = None
+    better_gps_path: Path | None = None,
+    cor_cache_dir: Path | None = None,
     ):
     """Run preprocessing steps for a Malå Ramac (rd3) dataset.
 
     1. Removes empty traces (if any)
     2. Corrects the coordinate information with an external track.
 
+    The radargram is streamed from the input to the output in chunks, so memory usage
+    is constant regardless of the file length.
+
     Parameters
     ----------
     output_rad_filepath
@@ -173,17 +661,21 @@ def preprocess_mala(
         Optional. The filepath to the cor file. If not given, it's assumed to lie beside the ".rad" file.
     better_gps_path
         Optional. The external track to replace the corfile contents with.
+    cor_cache_dir
+        Optional. A directory to cache the parsed corfile in (see read_cor). If None, no cache is used.
     """
     print(f"Loading {input_rad_filepath}")
-    gpr = load_ramac(rad_filepath=input_rad_filepath, rd3_filepath=input_rd3_filepath, cor_filepath=input_cor_filepath)
+    if input_rd3_filepath is None:
+        input_rd3_filepath = input_rad_filepath.with_suffix(".rd3")
+    gpr = load_ramac(rad_filepath=input_rad_filepath, rd3_filepath=input_rd3_filepath, cor_filepath=input_cor_filepath, mmap=True, cor_cache_dir=cor_cache_dir)
 
-    gpr = remove_empty_traces(gpr)
+    # The track replacement only concerns the corfile, so it can be done before the empty traces are removed
     if better_gps_path is not None:
         gpr = replace_gps_track(gpr, gps_filepath=better_gps_path)
 
     print(f"Saving {output_rad_filepath}")
     output_rad_filepath.parent.mkdir(exist_ok=True, parents=True)
-    save_ramac(output_rad_filepath=output_rad_filepath, gpr=gpr)
+    stream_remove_empty_traces(output_rad_filepath=output_rad_filepath, input_rd3_filepath=input_rd3_filepath, rad=gpr.rad, cor=gpr.cor)
 
     
 
@@ -0,0 +1,168 @@
+from pathlib import Path
+import numpy as np
+
+from preprocess_mala import resolve_trace_range
+
+# The default width in pixels (and the maximum number of read traces) of a preview
+PREVIEW_WIDTH = 2000
+
+# The height in pixels of the trace-index ruler below the radargram
+RULER_HEIGHT = 24
+
+
+def read_decimated(header_filepath: Path, max_traces: int = PREVIEW_WIDTH, trace_range: tuple[int, int] | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """Read every n-th trace of a level1 .rad/.hd file, so that at most max_traces are read.
+
+    The data file is memory-mapped and only the pages of the selected traces are read,
+    so the time taken depends on max_traces rather than the length of the file.
+
+    Parameters
+    ----------
+    header_filepath
+        The .rad/.hd header filepath of the data.
+    max_traces
+        The maximum number of traces to read.
+    trace_range
+        Optional. Only read within this inclusive (start, end) range of traces (see preprocess_mala.resolve_trace_range).
+
+    Returns
+    -------
+    The (samples, traces) data and the index of each read trace in the file.
+    """
+    if header_filepath.suffix == ".rad":
+        from preprocess_mala import load_ramac
+        gpr = load_ramac(header_filepath, mmap=True)
+    else:
+        from pulseekko import load_pulseekko
+        gpr = load_pulseekko(header_filepath, mmap=True)
+
+    start, end = resolve_trace_range(trace_range, gpr.n_traces) if trace_range is not None else (0, gpr.n_traces)
+    step = max(1, int(np.ceil((end - start) / max_traces)))
+    trace_indices = np.arange(start, end, step)
+
+    return np.ascontiguousarray(gpr.rd3[:, start:end:step].T).T, trace_indices
+
+
+def quicklook(data: np.ndarray, gain_power: float = 1., contrast_percentile: float = 99.) -> np.ndarray:
+    """Convert raw data to an 8 bit image with a fixed time gain.
+
+    1. The mean of each trace is removed.
+    2. A t^gain_power gain is applied (t in samples).
+    3. The amplitudes within +-contrast_percentile of the absolute data are mapped to 0-255.
+    """
+    values = data.astype("float32")
+    values -= values.mean(axis=0, keepdims=True)
+    values *= (np.arange(1, values.shape[0] + 1, dtype="float32") ** gain_power)[:, None]
+
+    limit = float(np.percentile(np.abs(values), contrast_percentile)) if values.size > 0 else 0.
+    values *= 127.5 / (limit + 1e-12)
+    values += 127.5
+    np.clip(values, 0, 255, out=values)
+    return values.astype("uint8")
+
+
+def _ruler_interval(trace_indices: np.ndarray, width: int, min_spacing: int = 80) -> int:
+    """Get a round tick interval in traces (1, 2 or 5 times a power of ten) with ticks at least min_spacing pixels apart."""
+    span = max(int(trace_indices[-1] - trace_indices[0]), 1) if trace_indices.size > 0 else 1
+    minimum = span * min_spacing / max(width, 1)
+    for magnitude in 10 ** np.arange(0, 10):
+        for factor in [1, 2, 5]:
+            if factor * magnitude >= minimum:
+                return int(factor * magnitude)
+    return int(span)
+
+
+def render_preview(image: np.ndarray, trace_indices: np.ndarray, marks: list[int] | None = None):
+    """Add a trace-index ruler below a preview image, and optionally mark trace indices with red lines.
+
+    Returns
+    -------
+    An RGB PIL image.
+    """
+    import PIL.Image
+    import PIL.ImageDraw
+
+    height, width = image.shape
+    canvas = PIL.Image.new("RGB", (width, height + RULER_HEIGHT), "white")
+    canvas.paste(PIL.Image.fromarray(image).convert("RGB"), (0, 0))
+    draw = PIL.ImageDraw.Draw(canvas)
+
+    def column(trace: int) -> int:
+        return int(np.searchsorted(trace_indices, trace, side="left"))
+
+    if trace_indices.size > 0:
+        interval = _ruler_interval(trace_indices, width)
+        first = -(-int(trace_indices[0]) // interval) * interval
+        for trace in range(first, int(trace_indices[-1]) + 1, interval):
+            x = column(trace)
+            draw.line([(x, height), (x, height + 5)], fill="black")
+            draw.text((x + 2, height + 6), str(trace), fill="black")
+
+    for trace in marks or []:
+        if trace_indices.size > 0 and trace_indices[0] <= trace <= trace_indices[-1]:
+            x = column(trace)
+            draw.line([(x, 0), (x, height + RULER_HEIGHT)], fill="red")
+
+    return canvas
+
+
+def preview(header_filepath: Path, output_filepath: Path | None = None, width: int = PREVIEW_WIDTH, trace_range: tuple[int, int] | None = None, gain_power: float = 1.) -> Path:
+    """Write a quick-look PNG of a level1 radargram with a trace-index ruler, without running rsgpr.
+
+    The data are read with strides (see read_decimated), so this takes seconds even for long lines.
+    The trace indices of the ruler are those of the level1 file, which is what the subsetting
+    ranges (see level2_processing.subsetting) refer to. If the radargram already has a subsetting range,
+    its bounds are marked in red.
+
+    Parameters
+    ----------
+    header_filepath
+        The .rad/.hd header filepath of the data.
+    output_filepath
+        Optional. The PNG filepath to write. Defaults to processed/preview/{stem}.png.
+    width
+        The maximum width in pixels (and number of read traces).
+    trace_range
+        Optional. Only show this inclusive (start, end) range of traces.
+    gain_power
+        The power of the time gain (see quicklook).
+
+    Returns
+    -------
+    The output_filepath.
+    """
+    from level2_processing import subsetting
+
+    if output_filepath is None:
+        output_filepath = Path("processed/preview") / (header_filepath.stem + ".png")
+
+    data, trace_indices = read_decimated(header_filepath, max_traces=width, trace_range=trace_range)
+
+    # An end of -1 means the last trace, which needs no mark
+    marks = None
+    if (subset := subsetting(header_filepath.stem)) is not None:
+        marks = [subset[0]] + ([subset[1]] if subset[1] != -1 else [])
+
+    output_filepath.parent.mkdir(exist_ok=True, parents=True)
+    render_preview(quicklook(data, gain_power=gain_power), trace_indices, marks=marks).save(output_filepath)
+    print(f"Saved {output_filepath} ({trace_indices.size} traces of {header_filepath.name})")
+
+    return output_filepath
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Write quick-look previews of level1 radargrams, e.g. to choose subsetting ranges.")
+    parser.add_argument("header_filepaths", nargs="+", type=Path, help="The .rad/.hd header filepaths of the data.")
+    parser.add_argument("--output", type=Path, default=None, help="The output PNG filepath (only with one input).")
+    parser.add_argument("--width", type=int, default=PREVIEW_WIDTH, help="The maximum width in pixels.")
+    parser.add_argument("--range", type=int, nargs=2, default=None, metavar=("START", "END"), help="Only show this inclusive range of traces. An END of -1 means the last trace.")
+    parser.add_argument("--gain", type=float, default=1., help="The power of the time gain.")
+    args = parser.parse_args()
+
+    if args.output is not None and len(args.header_filepaths) > 1:
+        parser.error("--output can only be used with one input")
+
+    for header_filepath in args.header_filepaths:
+        preview(header_filepath, output_filepath=args.output, width=args.width, trace_range=args.range, gain_power=args.gain)
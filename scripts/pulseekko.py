@@ -0,0 +1,297 @@
+from pathlib import Path
+import io
+import numpy as np
+import pandas as pd
+
+from preprocess_mala import GPR, CHUNK_TRACES, find_nonempty_traces, resolve_trace_range, stream_nonempty_traces, subset_coordinates
+from instrumentation import instrumented
+
+# The number of float32 values in the header of each trace in a .dt1 file
+TRACE_HEADER_VALUES = 32
+
+# The .hd "SURVEY MODE" values of gathers, whose traces are spaced by antenna separation instead of position
+GATHER_SURVEY_MODES = ["CMP", "WARR"]
+
+
+def dt1_dtype(n_samples: int) -> np.dtype:
+    """Get the dtype of one trace record in a .dt1 file: a 128 byte header followed by int16 samples."""
+    return np.dtype([("header", "<f4", (TRACE_HEADER_VALUES,)), ("samples", "<i2", (n_samples,))])
+
+
+def read_hd(hd_filepath: Path) -> dict[str, str | None]:
+    """Read a pulseEKKO .hd header.
+
+    "KEY = value" lines are parsed into key/value pairs. Other lines (the file tag, title and date)
+    are kept as keys with None as the value, so the header can be written back in the same order.
+    """
+    hd = {}
+    for line in hd_filepath.read_text(encoding="latin-1").splitlines():
+        if "=" in line:
+            key, value = line.split("=", 1)
+            hd[key.strip()] = value.strip()
+        elif line.strip() != "":
+            hd[line.strip()] = None
+    return hd
+
+
+def is_gather(hd: dict[str, str | None]) -> bool:
+    """Check if a pulseEKKO .hd header belongs to a gather (e.g. a CMP), from its "SURVEY MODE" (see GATHER_SURVEY_MODES)."""
+    survey_mode = (hd.get("SURVEY MODE") or "").upper()
+    return any(mode in survey_mode for mode in GATHER_SURVEY_MODES)
+
+
+def write_hd(hd_filepath: Path, hd: dict[str, str | None]):
+    """Write a pulseEKKO .hd header. See read_hd.
+
+    The keys are padded to 18 characters and the lines end with "\\n". An unchanged header that was written
+    in the same layout is thus written back identically. Headers with other padding or line endings
+    (e.g. from other pulseEKKO versions) keep their keys and values, but not their whitespace.
+    """
+    hd_text = "\n".join([key if value is None else f"{key:<18} = {value}" for key, value in hd.items()])
+    hd_filepath.write_text(hd_text + "\n", encoding="latin-1")
+
+
+def read_gp2(gp2_filepath: Path) -> pd.DataFrame:
+    """Read a pulseEKKO .gp2 GPS file.
+
+    The columns keep their position in the file as labels (0: trace number, 1-based), and are otherwise
+    kept as text. The lines before the first trace (comments and column names) are saved in attrs["preamble"].
+    """
+    lines = gp2_filepath.read_text(encoding="latin-1").splitlines()
+
+    n_preamble = 0
+    for line in lines:
+        if line.split(",", 1)[0].strip().isdigit():
+            break
+        n_preamble += 1
+
+    if n_preamble < len(lines):
+        gp2 = pd.read_csv(io.StringIO("\n".join(lines[n_preamble:])), header=None, dtype=str, keep_default_na=False)
+        gp2[0] = gp2[0].astype("int64")
+    else:
+        gp2 = pd.DataFrame({0: np.empty(0, dtype="int64")})
+    gp2.attrs["preamble"] = lines[:n_preamble]
+
+    return gp2
+
+
+def write_gp2(gp2_filepath: Path, gp2: pd.DataFrame):
+    """Write a pulseEKKO .gp2 GPS file. See read_gp2."""
+    with open(gp2_filepath, "w", encoding="latin-1", newline="") as outfile:
+        _write_gp2_rows(outfile, gp2, preamble=gp2.attrs.get("preamble", []))
+
+
+def _write_gp2_rows(outfile, gp2: pd.DataFrame, preamble: list[str] | None = None):
+    if preamble:
+        outfile.write("\n".join(preamble) + "\n")
+    gp2.to_csv(outfile, header=False, index=False, lineterminator="\n")
+
+
+def load_pulseekko(hd_filepath: Path, dt1_filepath: Path | None = None, gp2_filepath: Path | None = None, mmap: bool = False, trace_range: tuple[int, int] | None = None) -> GPR:
+    """Load a pulseEKKO file.
+
+    The header goes in GPR.rad, the GPS file in GPR.cor and the (traces, 32) trace headers in GPR.trace_headers.
+    If there is no GPS file, GPR.cor is empty.
+
+    Parameters
+    ----------
+    hd_filepath
+        The input filepath to the data. Must end with ".hd"
+    dt1_filepath
+        Optional. The filepath to the dt1 file. If not given, it's assumed to lie beside the ".hd" file.
+    gp2_filepath
+        Optional. The filepath to the gp2 file. If not given, it's assumed to lie beside the ".hd" file.
+    mmap
+        Memory-map the dt1 file instead of reading it. The samples and trace headers are then strided
+        views that skip over each other, and traces are only read when accessed.
+    trace_range
+        Optional. Only load the inclusive (start, end) range of traces (see preprocess_mala.resolve_trace_range).
+        Only that part of the dt1 file is read, and the trace numbers of the trace headers are renumbered from 1.
+        The GPS file is subset to match, keeping the nearest fix on each side (see preprocess_mala.subset_coordinates).
+
+    Returns
+    -------
+    A loaded GPR class.
+    """
+    if hd_filepath.suffix.lower() != ".hd":
+        raise ValueError(f"Possibly wrong hd_filepath provided: {hd_filepath}")
+    if dt1_filepath is None:
+        dt1_filepath = hd_filepath.with_suffix(".dt1")
+    if gp2_filepath is None:
+        gp2_filepath = hd_filepath.with_suffix(".gp2")
+
+    hd = read_hd(hd_filepath)
+
+    if gp2_filepath.is_file():
+        gp2 = read_gp2(gp2_filepath)
+    else:
+        gp2 = pd.DataFrame({0: np.empty(0, dtype="int64")})
+
+    dtype = dt1_dtype(int(hd["NUMBER OF PTS/TRC"]))
+    n_traces = dt1_filepath.stat().st_size // dtype.itemsize
+    start, end = 0, n_traces
+    if trace_range is not None:
+        start, end = resolve_trace_range(trace_range, n_traces)
+        preamble = gp2.attrs.get("preamble", [])
+        gp2 = subset_coordinates(gp2, start, end)
+        gp2.attrs["preamble"] = preamble
+        hd["NUMBER OF TRACES"] = str(end - start)
+
+    # Only the requested traces are read, by starting at their byte offset
+    if mmap and end > start:
+        records = np.memmap(dt1_filepath, dtype=dtype, mode="r", offset=start * dtype.itemsize, shape=(end - start,))
+    else:
+        records = np.fromfile(dt1_filepath, dtype=dtype, offset=start * dtype.itemsize, count=end - start)
+
+    trace_headers = records["header"]
+    if trace_range is not None:
+        # The trace headers are small, so they're copied to renumber them
+        trace_headers = np.array(trace_headers)
+        trace_headers[:, 0] = np.arange(1, end - start + 1)
+
+    return GPR(rd3=records["samples"].T, rad=hd, cor=gp2, trace_headers=trace_headers)
+
+
+def save_pulseekko(output_hd_filepath: Path, gpr: GPR) -> None:
+    """Save a pulseEKKO file to disk.
+
+    Parameters
+    ----------
+    output_hd_filepath
+        The output filepath of the data. Must end with ".hd". Other files are saved beside it.
+    gpr
+        The data to save. Its trace_headers must be set.
+    """
+    if output_hd_filepath.suffix.lower() != ".hd":
+        raise ValueError("The output hd file must have a '.hd' suffix")
+    if gpr.trace_headers is None:
+        raise ValueError("pulseEKKO data need trace headers to be saved")
+
+    write_hd(output_hd_filepath, gpr.rad)
+    if gpr.cor.shape[0] > 0:
+        write_gp2(output_hd_filepath.with_suffix(".gp2"), gpr.cor)
+
+    # Write the dt1 in chunks to avoid making full copies of the (possibly memory-mapped) data
+    dtype = dt1_dtype(gpr.rd3.shape[0])
+    with open(output_hd_filepath.with_suffix(".dt1"), "wb") as outfile:
+        for start, block in gpr.iter_trace_chunks():
+            records = np.empty(block.shape[1], dtype=dtype)
+            records["header"] = gpr.trace_headers[start:start + block.shape[1]]
+            records["samples"] = block.T
+            records.tofile(outfile)
+
+
+def stream_remove_empty_traces(output_hd_filepath: Path, input_dt1_filepath: Path, hd: dict[str, str | None], gp2: pd.DataFrame, chunk_size: int = CHUNK_TRACES) -> int:
+    """Remove empty traces while streaming a dt1 file into a new pulseEKKO file.
+
+    The dt1 is read and written in blocks of traces, and the GPS file is re-indexed block by block,
+    so the memory usage is independent of the file length (see preprocess_mala.stream_nonempty_traces).
+    The trace numbers in the trace headers and the GPS file are renumbered to match the new trace positions.
+
+    Parameters
+    ----------
+    output_hd_filepath
+        The output filepath of the corrected data. Must end with ".hd". Other files are saved beside it.
+    input_dt1_filepath
+        The filepath to the dt1 file to read.
+    hd
+        The header of the input data.
+    gp2
+        The GPS positions of the input data. If empty, no gp2 file is written.
+    chunk_size
+        The number of traces to read at a time.
+
+    Returns
+    -------
+    The number of removed traces.
+    """
+    if output_hd_filepath.suffix.lower() != ".hd":
+        raise ValueError("The output hd file must have a '.hd' suffix")
+    dtype = dt1_dtype(int(hd["NUMBER OF PTS/TRC"]))
+
+    def renumber(kept: np.ndarray, n_kept: int):
+        # The trace numbers in the trace headers are 1-based
+        kept["header"][:, 0] = np.arange(n_kept + 1, n_kept + len(kept) + 1)
+
+    with (
+        open(input_dt1_filepath, "rb") as dt1_infile,
+        open(output_hd_filepath.with_suffix(".dt1"), "wb") as dt1_outfile,
+        open(output_hd_filepath.with_suffix(".gp2"), "w", encoding="latin-1", newline="") as gp2_outfile,
+    ):
+        if gp2.shape[0] > 0:
+            _write_gp2_rows(gp2_outfile, gp2.iloc[:0], preamble=gp2.attrs.get("preamble", []))
+
+        n_read, n_kept = stream_nonempty_traces(
+            dt1_infile,
+            dt1_outfile,
+            dtype=dtype,
+            coords=gp2,
+            write_coords=lambda gp2_block: _write_gp2_rows(gp2_outfile, gp2_block),
+            samples=lambda records: records["samples"],
+            renumber=renumber,
+            chunk_size=chunk_size,
+        )
+
+    if gp2.shape[0] == 0:
+        output_hd_filepath.with_suffix(".gp2").unlink()
+
+    n_removed = n_read - n_kept
+    if n_removed > 0:
+        print(f"Removed {n_removed} empty traces")
+        hd = hd.copy()
+        hd["NUMBER OF TRACES"] = str(n_kept)
+
+    write_hd(output_hd_filepath, hd)
+
+    return n_removed
+
+
+@instrumented("input_hd_filepath")
+def preprocess_pulseekko(
+    output_hd_filepath: Path,
+    input_hd_filepath: Path,
+    input_dt1_filepath: Path | None = None,
+    input_gp2_filepath: Path | None = None,
+    ) -> bool:
+    """Run preprocessing steps for a pulseEKKO (dt1) dataset.
+
+    1. Removes empty traces (if any)
+
+    The dt1 file is first checked for empty traces through a memory map. Only if there are any,
+    the data are streamed from the input to the output in chunks.
+
+    Gathers (see is_gather) are never changed. The offset of each of their traces is given by its position
+    in the file (see velocity_analysis.read_cmp), which removing traces would shift.
+
+    Parameters
+    ----------
+    output_hd_filepath
+        The output filepath of the corrected data. Must end with ".hd". Other files are saved beside it.
+    input_hd_filepath
+        The input filepath to the data. Must end with ".hd"
+    input_dt1_filepath
+        Optional. The filepath to the dt1 file. If not given, it's assumed to lie beside the ".hd" file.
+    input_gp2_filepath
+        Optional. The filepath to the gp2 file. If not given, it's assumed to lie beside the ".hd" file.
+
+    Returns
+    -------
+    Whether the data needed changes. If not, nothing is written and the input files can be used as they are.
+    """
+    print(f"Loading {input_hd_filepath}")
+    if input_dt1_filepath is None:
+        input_dt1_filepath = input_hd_filepath.with_suffix(".dt1")
+    gpr = load_pulseekko(hd_filepath=input_hd_filepath, dt1_filepath=input_dt1_filepath, gp2_filepath=input_gp2_filepath, mmap=True)
+
+    if is_gather(gpr.rad):
+        print(f"Skipping empty trace removal of {input_hd_filepath}: it is a {gpr.rad['SURVEY MODE']} gather")
+        return False
+
+    if find_nonempty_traces(gpr).all():
+        return False
+
+    print(f"Saving {output_hd_filepath}")
+    output_hd_filepath.parent.mkdir(exist_ok=True, parents=True)
+    stream_remove_empty_traces(output_hd_filepath=output_hd_filepath, input_dt1_filepath=input_dt1_filepath, hd=gpr.rad, gp2=gpr.cor)
+
+    return True
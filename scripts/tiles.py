@@ -0,0 +1,103 @@
+from pathlib import Path
+import json
+import shutil
+import numpy as np
+
+from level2_processing import normalize, open_level2, _estimate_contrast_limits
+
+# The width and height of each tile in pixels
+TILE_SIZE = 256
+
+
+def _downsample(image: np.ndarray) -> np.ndarray:
+    """Halve the size of an image by averaging 2x2 blocks. Odd edges are padded by repetition."""
+    pad = ((0, image.shape[0] % 2), (0, image.shape[1] % 2))
+    if pad[0][1] or pad[1][1]:
+        image = np.pad(image, pad, mode="edge")
+    height, width = image.shape
+    return np.round(image.reshape((height // 2, 2, width // 2, 2)).mean(axis=(1, 3))).astype(image.dtype)
+
+
+def _save_tiles(image: np.ndarray, level_dir: Path, col_offset: int, tile_size: int, image_format: str):
+    """Cut an image into tiles and save them as {col}_{row}.{image_format}, starting at a given column."""
+    import PIL.Image
+
+    level_dir.mkdir(exist_ok=True, parents=True)
+    for row, top in enumerate(range(0, image.shape[0], tile_size)):
+        for col, left in enumerate(range(0, image.shape[1], tile_size)):
+            tile = image[top:top + tile_size, left:left + tile_size]
+            PIL.Image.fromarray(tile).save(level_dir / f"{col_offset + col}_{row}.{image_format}")
+
+
+def generate_tiles(processed_filepath: Path, redo: bool = False, image_format: str = "jpg", tile_size: int = TILE_SIZE, window_levels: int = 4):
+    """Generate a multi-resolution (DeepZoom) tile pyramid of a processed radargram.
+
+    The pyramid is saved beside the processed file as {stem}.dzi and {stem}_files/{level}/{col}_{row}.{image_format},
+    which can be opened in e.g. OpenSeadragon. The radargram is read in windows of tile_size * 2**window_levels
+    traces, from which the finest levels are cut. The coarser overview levels are then built from
+    a small downsampled copy, so the memory usage is independent of the radargram length.
+
+    The pyramid is only regenerated if the processed file changed since the last time.
+
+    Parameters
+    ----------
+    processed_filepath
+        The filepath to the processed (.nc or .zarr) data.
+    redo
+        Regenerate the tiles despite being up to date.
+    image_format
+        The image format of the tiles ("jpg" or "png").
+    tile_size
+        The width and height of each tile in pixels.
+    window_levels
+        How many levels to build from each window of the full resolution data.
+    """
+    dzi_path = processed_filepath.with_suffix(".dzi")
+    tiles_dir = processed_filepath.with_name(processed_filepath.stem + "_files")
+    stamp_path = processed_filepath.with_name(processed_filepath.stem + "_files.json")
+
+    stat = processed_filepath.stat()
+    stamp = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "image_format": image_format, "tile_size": tile_size}
+    if not redo and dzi_path.is_file() and stamp_path.is_file() and json.loads(stamp_path.read_text()) == stamp:
+        return
+
+    # Build the new pyramid beside the old one, and only swap them when it's done
+    tmp_dir = tiles_dir.with_name(tiles_dir.name + ".tmp")
+    if tmp_dir.is_dir():
+        shutil.rmtree(tmp_dir)
+
+    with open_level2(processed_filepath) as data:
+        height, width = data["data"].shape
+        max_level = int(np.ceil(np.log2(max(height, width, 2))))
+        window_levels = min(window_levels, max_level)
+        window_width = tile_size * 2 ** window_levels
+
+        limits = _estimate_contrast_limits(data["data"])
+
+        # The finest levels are made one window at a time, and the coarsest of them is kept as an overview
+        overview = []
+        for start in range(0, width, window_width):
+            image = normalize(data.data.isel(x=slice(start, start + window_width)).values, limits=limits)
+            for k in range(window_levels + 1):
+                if k > 0:
+                    image = _downsample(image)
+                _save_tiles(image, tmp_dir / str(max_level - k), col_offset=(start // 2 ** k) // tile_size, tile_size=tile_size, image_format=image_format)
+            overview.append(image)
+
+    # The remaining levels are small enough to build in memory
+    image = np.concatenate(overview, axis=1)
+    for level in range(max_level - window_levels - 1, -1, -1):
+        image = _downsample(image)
+        _save_tiles(image, tmp_dir / str(level), col_offset=0, tile_size=tile_size, image_format=image_format)
+
+    if tiles_dir.is_dir():
+        shutil.rmtree(tiles_dir)
+    tmp_dir.rename(tiles_dir)
+
+    dzi_path.write_text(
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{image_format}" Overlap="0" TileSize="{tile_size}">\n'
+        f'  <Size Width="{width}" Height="{height}"/>\n'
+        '</Image>\n'
+    )
+    stamp_path.write_text(json.dumps(stamp))
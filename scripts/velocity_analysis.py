@@ -0,0 +1,244 @@
+from pathlib import Path
+from typing import Iterable
+import concurrent.futures
+import os
+import numpy as np
+
+# The default memory budget in bytes of the intermediate (gathers, velocities, times, offsets) array
+DEFAULT_MEMORY_BUDGET = 256e6
+
+MOVEOUTS = ["hyperbolic", "linear"]
+MEASURES = ["amplitude", "semblance"]
+
+
+def moveout_indices(twtt: np.ndarray, offsets: np.ndarray, velocities: np.ndarray, moveout: str = "hyperbolic") -> np.ndarray:
+    """Get the sample index of each (velocity, zero-offset time, offset) along the moveout curves.
+
+    The hyperbolic moveout is t(x) = sqrt(t0² + (x / v)²) and the linear moveout is t(x) = t0 + x / v.
+    Indices that are outside of the recorded time window are set to twtt.size.
+
+    Parameters
+    ----------
+    twtt
+        The evenly spaced two-way travel times in ns of the samples, which are also used as zero-offset times.
+    offsets
+        The antenna offsets in m of the traces.
+    velocities
+        The velocities in m/ns.
+    moveout
+        The shape of the moveout curves. One of MOVEOUTS.
+
+    Returns
+    -------
+    A (velocities, twtt, offsets) array of sample indices.
+    """
+    if moveout not in MOVEOUTS:
+        raise ValueError(f"Unknown moveout: {moveout}. Choices: {MOVEOUTS}")
+
+    t0 = twtt[None, :, None]
+    slowness = (offsets[None, None, :] / velocities[:, None, None])
+    if moveout == "hyperbolic":
+        times = np.sqrt(t0 ** 2 + slowness ** 2)
+    else:
+        times = t0 + slowness
+
+    dt = twtt[1] - twtt[0]
+    indices = np.rint((times - twtt[0]) / dt)
+    return np.where((indices >= 0) & (indices < twtt.size), indices, twtt.size).astype(np.intp)
+
+
+def _windowed_sum(values: np.ndarray, window: int) -> np.ndarray:
+    """Sum values in a centered moving window along the last axis."""
+    if window <= 1:
+        return values
+    cumsum = np.concatenate([np.zeros(values.shape[:-1] + (1,), dtype=values.dtype), np.cumsum(values, axis=-1)], axis=-1)
+    n = values.shape[-1]
+    lower = np.clip(np.arange(n) - window // 2, 0, n)
+    upper = np.clip(np.arange(n) + (window - window // 2), 0, n)
+    return cumsum[..., upper] - cumsum[..., lower]
+
+
+def _velocity_chunk(padded: np.ndarray, flat_indices: np.ndarray, count: np.ndarray, measure: str, window: int) -> np.ndarray:
+    """Compute the measure of a batch of gathers for a chunk of velocities.
+
+    Parameters
+    ----------
+    padded
+        The (gathers, (twtt + 1) * offsets) flattened gathers, padded with a row of zeros.
+    flat_indices
+        The (velocities, twtt, offsets) indices along the moveout curves into the flattened gathers.
+    count
+        The (velocities, twtt) number of samples along each moveout curve that are within the time window.
+
+    Returns
+    -------
+    A (gathers, velocities, twtt) array.
+    """
+    # The padded row is zero, so the samples outside of the time window don't contribute.
+    # A flat take is much faster than indexing the twtt and offset axes separately.
+    values = np.take(padded, flat_indices, axis=1)
+    total = values.sum(axis=-1)
+
+    if measure == "amplitude":
+        return np.abs(total) / np.maximum(count, 1)
+
+    numerator = _windowed_sum(total ** 2, window)
+    denominator = _windowed_sum(count * (values ** 2).sum(axis=-1), window)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(denominator > 0, numerator / denominator, 0.)
+
+
+def velocity_spectra(
+    gathers: Iterable[np.ndarray],
+    twtt: np.ndarray,
+    offsets: np.ndarray,
+    velocities: np.ndarray,
+    moveout: str = "hyperbolic",
+    measure: str = "amplitude",
+    window: int = 1,
+    return_each: bool = False,
+    memory_budget: float = DEFAULT_MEMORY_BUDGET,
+    workers: int | None = None,
+) -> np.ndarray | tuple[np.ndarray, list[np.ndarray]]:
+    """Calculate the velocity spectrum of CMP gathers, and the mean (stacked) spectrum of all gathers.
+
+    All velocities and gathers are evaluated with vectorized lookups along precomputed moveout curves.
+    The gathers are processed in batches and the velocities in chunks that fit in the memory budget,
+    and the chunks are computed in parallel threads. The stack is accumulated batch by batch,
+    so only one batch of gathers has to be in memory at a time.
+
+    Parameters
+    ----------
+    gathers
+        The (twtt, offsets) CMP gathers. They must all have the same shape. This may be a generator.
+    twtt
+        The evenly spaced two-way travel times in ns of the samples, which are also used as zero-offset times.
+    offsets
+        The antenna offsets in m of the traces.
+    velocities
+        The velocities in m/ns to evaluate.
+    moveout
+        The shape of the moveout curves (see moveout_indices). One of MOVEOUTS.
+    measure
+        "amplitude": The absolute mean amplitude along the moveout curve (the "stacked amplitude").
+        "semblance": The normalized coherence along the moveout curve, between 0 and 1.
+    window
+        The number of samples to sum the semblance over. Only used with "semblance".
+    return_each
+        Also return the spectrum of each gather.
+    memory_budget
+        The approximate memory budget in bytes of the intermediate arrays.
+    workers
+        Optional. The number of threads. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    The (twtt, velocities) stacked spectrum, and if return_each is True, the (twtt, velocities) spectrum of each gather.
+    """
+    if measure not in MEASURES:
+        raise ValueError(f"Unknown measure: {measure}. Choices: {MEASURES}")
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    velocities = np.asarray(velocities, dtype="float64")
+    twtt = np.asarray(twtt, dtype="float64")
+    offsets = np.asarray(offsets, dtype="float64")
+    shape = (twtt.size, offsets.size)
+
+    # The intermediate array of a chunk has the shape (gathers, velocities, twtt, offsets)
+    bytes_per_velocity = 8 * twtt.size * offsets.size
+    batch_size = int(max(1, min(32, memory_budget // (bytes_per_velocity * workers))))
+    chunk_size = int(max(1, memory_budget // (bytes_per_velocity * batch_size * workers)))
+    chunks = [slice(start, start + chunk_size) for start in range(0, velocities.size, chunk_size)]
+    chunk_indices = []
+    chunk_counts = []
+    for chunk in chunks:
+        indices = moveout_indices(twtt, offsets, velocities[chunk], moveout=moveout)
+        chunk_counts.append((indices < twtt.size).sum(axis=-1))
+        # The indices are kept for all gathers, so they're stored in 32 bits to halve their memory usage
+        chunk_indices.append((indices * offsets.size + np.arange(offsets.size)).astype(np.int32))
+
+    stack = np.zeros((velocities.size, twtt.size))
+    n_gathers = 0
+    each = []
+
+    def process_batch(batch: list[np.ndarray]):
+        padded = np.zeros((len(batch), shape[0] + 1, shape[1]), dtype="float64")
+        padded[:, :-1] = batch
+        padded = padded.reshape((len(batch), -1))
+        spectra = np.empty((len(batch), velocities.size, twtt.size))
+
+        def process_chunk(i: int):
+            spectra[:, chunks[i]] = _velocity_chunk(padded, chunk_indices[i], chunk_counts[i], measure=measure, window=window)
+
+        for future in [executor.submit(process_chunk, i) for i in range(len(chunks))]:
+            future.result()
+
+        stack[:] += spectra.sum(axis=0)
+        if return_each:
+            each.extend(spectrum.T for spectrum in spectra)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        batch = []
+        for gather in gathers:
+            if gather.shape != shape:
+                raise ValueError(f"Gather shape {gather.shape} differs from the expected (twtt, offsets) {shape}")
+            batch.append(gather)
+            if len(batch) == batch_size:
+                process_batch(batch)
+                n_gathers += len(batch)
+                batch = []
+        if len(batch) > 0:
+            process_batch(batch)
+            n_gathers += len(batch)
+
+    if n_gathers == 0:
+        raise ValueError("No gathers were given")
+
+    stacked = (stack / n_gathers).T
+    if return_each:
+        return stacked, each
+    return stacked
+
+
+def read_cmp(hd_filepath: Path, offset_range: tuple[float, float] = (0., 10.), gain_power: float = 1., shift_timezero: bool = False) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Read a pulseEKKO CMP gather and apply the default processing of the CMP notebook.
+
+    1. The offsets are spaced evenly within the offset range.
+    2. Each trace is normalized by its maximum absolute amplitude.
+    3. A t^gain_power gain is applied.
+
+    Parameters
+    ----------
+    hd_filepath
+        The filepath to the .hd header of the gather.
+    offset_range
+        The offsets in m of the first and last trace.
+    gain_power
+        The power of the time gain.
+    shift_timezero
+        Shift the two-way travel times so that the "TIMEZERO AT POINT" sample of the header is at 0 ns.
+        The CMP notebook (gprpy) doesn't do this, so it's off by default to give the same times as the notebook.
+
+    Returns
+    -------
+    The (twtt, offsets) gather, the twtt in ns and the offsets in m.
+    """
+    from pulseekko import load_pulseekko
+
+    gpr = load_pulseekko(hd_filepath)
+    n_samples, n_traces = gpr.rd3.shape
+
+    time_window = float(gpr.rad["TOTAL TIME WINDOW"])
+    dt = time_window / (n_samples - 1)
+    twtt = np.linspace(0, time_window, n_samples)
+    if shift_timezero:
+        twtt -= float(gpr.rad.get("TIMEZERO AT POINT") or 0.) * dt
+    offsets = np.linspace(*offset_range, n_traces)
+
+    gather = gpr.rd3.astype("float64")
+    max_amplitude = np.abs(gather).max(axis=0)
+    gather /= np.where(max_amplitude > 0, max_amplitude, 1.)[None, :]
+    gather *= np.abs(twtt[:, None]) ** gain_power
+
+    return gather, twtt, offsets
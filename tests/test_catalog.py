@@ -0,0 +1,37 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from catalog import read_level1_summary
+from preprocess_mala import TIME_EPOCH
+from pulseekko import dt1_dtype, write_gp2, write_hd
+
+
+def test_pulseekko_time_span_from_gga(tmp_path):
+    hd_filepath = tmp_path / "austfonna-profile-2025-200MHz-pulseekko-01.hd"
+    n_traces, n_samples = 20, 10
+    write_hd(hd_filepath, {"1234": None, "Data Collected with GPS": None, "2025-Apr-20": None, "NUMBER OF TRACES": str(n_traces), "NUMBER OF PTS/TRC": str(n_samples)})
+    np.zeros(n_traces, dtype=dt1_dtype(n_samples)).tofile(hd_filepath.with_suffix(".dt1"))
+
+    # The fixes pass midnight (UTC). The time column is the time elapsed since the start.
+    utc = ["235958.00", "235959.50", "000001.00"]
+    gp2 = pd.DataFrame({
+        0: [1, 10, 20],
+        1: "0.1",
+        2: "0.2",
+        3: ["0.0", "1.5", "3.0"],
+        4: [f"$GPGGA,{time},7930.0000,N,02400.0000,E,1,12,0.8,500.0,M,30.0,M,," for time in utc],
+    })
+    gp2.attrs["preamble"] = ["traces,odo_tick,pos(m),time_elapsed(s),GPS"]
+    write_gp2(hd_filepath.with_suffix(".gp2"), gp2)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        summary = read_level1_summary(hd_filepath)
+
+    start = np.datetime64("2025-04-20T23:59:58", "s")
+    assert summary["time_start"] == (start - TIME_EPOCH).astype("float64")
+    assert summary["time_end"] == summary["time_start"] + 3
+    assert summary["lat_min"] == 79.5
+    assert summary["lon_min"] == 24.
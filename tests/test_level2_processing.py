@@ -0,0 +1,132 @@
+import numpy as np
+
+from level2_processing import AbsHistogram, _maxplus_quadratic, _maxplus_quadratic_batched, _track_ridge, approx_contrast_limits, normalize
+
+
+def test_abs_histogram_ignores_inf_and_nan():
+    data = np.random.default_rng(0).normal(size=(200, 300))
+    data[5, 5] = np.inf
+    data[6, 6] = -np.inf
+    data[7, 7] = np.nan
+
+    histogram = AbsHistogram()
+    histogram.update(data)
+    expected = np.percentile(np.abs(data[np.isfinite(data)]), [1, 99])
+
+    np.testing.assert_allclose(histogram.percentiles([1, 99]), expected, atol=2 * histogram.upper / histogram.n_bins)
+
+    limits = approx_contrast_limits(data)
+    assert np.all(np.isfinite(limits))
+    # Infinite values used to hang the streaming histogram. They are clipped to the ends of the range.
+    normalized = normalize(np.nan_to_num(data, nan=0., posinf=np.inf, neginf=-np.inf))
+    assert normalized[5, 5] == 255
+    assert normalized[6, 6] == 0
+
+
+def test_abs_histogram_int16_min():
+    data = np.random.default_rng(0).integers(-1000, 1000, size=(200, 300), dtype=np.int16)
+    data[60, 0] = np.iinfo(np.int16).min
+
+    histogram = AbsHistogram()
+    histogram.update(data)
+    expected = np.percentile(np.abs(data.astype(np.int32)), [1, 99])
+
+    np.testing.assert_allclose(histogram.percentiles([1, 99]), expected, atol=2 * histogram.upper / histogram.n_bins)
+    assert normalize(data).shape == data.shape
+
+
+def test_abs_histogram_zero_first_chunk():
+    rng = np.random.default_rng(0)
+    chunks = [np.zeros((100, 50)), rng.uniform(-2.5e-5, 2.5e-5, size=(100, 50))]
+
+    histogram = AbsHistogram()
+    for chunk in chunks:
+        histogram.update(chunk)
+    expected = np.percentile(np.abs(np.concatenate(chunks, axis=1)), [1, 60, 99])
+    max_abs = np.abs(chunks[1]).max()
+
+    # Half of the values are zero, so the 1st percentile is exactly zero
+    assert histogram.percentiles([1])[0] == 0
+    np.testing.assert_allclose(histogram.percentiles([1, 60, 99]), expected, atol=2 * max_abs / histogram.n_bins)
+
+
+def test_abs_histogram_empty():
+    histogram = AbsHistogram()
+    histogram.update(np.full((100, 10), np.nan))
+
+    assert np.all(np.isnan(histogram.percentiles([1, 99])))
+
+
+def test_batched_ridge_tracking_matches_single():
+    rng = np.random.default_rng(0)
+    freqs = np.linspace(0.003, 0.3, 150)
+    log_power = rng.normal(size=(2, 3, freqs.size, 20))
+    # Rounded values give (near) ties, where rounding may pick either predecessor, so the scores are compared
+    values = np.round(rng.normal(size=(6, freqs.size)), 1)
+
+    for alpha in [0., 1500.]:
+        scores = values[:, None, :] - alpha * (freqs[:, None] - freqs[None, :]) ** 2
+        for best in [np.stack([_maxplus_quadratic(row, freqs, alpha) for row in values]), _maxplus_quadratic_batched(values, freqs, alpha)]:
+            np.testing.assert_allclose(np.take_along_axis(scores, best[..., None], axis=-1)[..., 0], scores.max(axis=-1), rtol=0, atol=1e-12)
+
+        ridges = _track_ridge(log_power, freqs, alpha)
+        assert ridges.shape == (2, 3, 20)
+        for index in np.ndindex(2, 3):
+            np.testing.assert_array_equal(ridges[index], _track_ridge(log_power[index], freqs, alpha))
+
+
+def test_streaming_render_memory_is_bounded(tmp_path):
+    import tracemalloc
+    import xarray as xr
+    from level2_processing import IMAGE_FORMATS, generate_jpgs
+
+    # Shorter than one JPG strip, so the whole radargram is one image
+    n_samples, n_traces = 500, 50000
+    assert n_traces < IMAGE_FORMATS["jpg"]
+    data = np.random.default_rng(0).normal(size=(n_samples, n_traces)).astype("float32")
+    filepath = tmp_path / "radargram.nc"
+    xr.Dataset({"data": (("y", "x"), data)}).to_netcdf(filepath)
+    data_bytes = data.nbytes
+    del data
+
+    tracemalloc.start()
+    try:
+        generate_jpgs(filepath, redo=True, streaming=True, workers=2)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert (tmp_path / "radargram.jpg").is_file()
+    # Reading the whole radargram would take at least data_bytes. The 8 bit image is a quarter
+    # of that, and only a few windows of float data are read at a time.
+    assert peak < 0.75 * data_bytes
+
+
+def test_chunked_power_correction_matches_in_memory_on_packed_input(tmp_path):
+    import shutil
+    import xarray as xr
+    from level2_processing import fix_power_variation
+
+    rng = np.random.default_rng(0)
+    n_samples, n_traces = 100, 3000
+    power = 1 + 0.5 * np.sin(np.linspace(0, 20, n_traces))
+    source = xr.Dataset(
+        {"data": (("y", "x"), rng.normal(size=(n_samples, n_traces)) * power[None, :])},
+        coords={"depth": ("y", np.linspace(0, 20, n_samples)), "distance": ("x", np.arange(n_traces) * 0.1)},
+        attrs={"time-interval": 0.5},
+    )
+    source_filepath = tmp_path / "source.nc"
+    # A packed int16 source, whose packing should not be reused for the corrected values
+    source.to_netcdf(source_filepath, encoding={"data": {"dtype": "int16", "scale_factor": 0.000155, "_FillValue": np.int16(-32768)}})
+
+    for profile in ["archive", "balanced"]:
+        filepaths = {}
+        for chunk_size in [None, 500]:
+            filepaths[chunk_size] = tmp_path / f"{profile}_{chunk_size}.nc"
+            shutil.copy(source_filepath, filepaths[chunk_size])
+            fix_power_variation(filepaths[chunk_size], chunk_size=chunk_size, encoding_profile=profile)
+
+        with xr.open_dataset(filepaths[None], mask_and_scale=False) as in_memory, xr.open_dataset(filepaths[500], mask_and_scale=False) as chunked:
+            assert in_memory["data"].dtype == chunked["data"].dtype
+            np.testing.assert_equal(in_memory["data"].attrs, chunked["data"].attrs)
+            np.testing.assert_array_equal(in_memory["data"].values, chunked["data"].values)
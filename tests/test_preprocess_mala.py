@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+from preprocess_mala import resolve_trace_range, subset_coordinates
+
+
+def _positions(coords: pd.DataFrame, n_traces: int) -> np.ndarray:
+    """Interpolate the coordinates of every trace by trace number, like rsgpr does."""
+    return np.array([np.interp(np.arange(1, n_traces + 1), coords[0], coords[column]) for column in [3, 5, 7]])
+
+
+def test_resolve_trace_range_is_inclusive():
+    assert resolve_trace_range((0, 499), 1000) == (0, 500)
+    assert resolve_trace_range((100, -1), 1000) == (100, 1000)
+    assert resolve_trace_range((100, 5000), 1000) == (100, 1000)
+
+
+def test_subset_coordinates_keeps_positions():
+    n_traces = 1000
+    traces = np.arange(1, n_traces + 1, 7)
+    rng = np.random.default_rng(0)
+    coords = pd.DataFrame({
+        0: traces,
+        1: "2025-04-20",
+        2: "10:00:00",
+        3: 79 + rng.random(traces.size).cumsum() * 1e-4,
+        4: "N",
+        5: 24 + rng.random(traces.size).cumsum() * 1e-4,
+        6: "E",
+        7: 500 + rng.random(traces.size),
+    })
+    full = _positions(coords, n_traces)
+
+    for trace_range in [(100, 499), (3, 800), (0, -1), (250, 250)]:
+        start, stop = resolve_trace_range(trace_range, n_traces)
+        subset = subset_coordinates(coords, start, stop, interpolate=[3, 5, 7])
+        assert subset[0].between(1, stop - start).all()
+        np.testing.assert_allclose(_positions(subset, stop - start), full[:, start:stop])
+
+        # Without interpolation, the nearest fixes outside of the range are kept as anchors
+        subset = subset_coordinates(coords, start, stop)
+        np.testing.assert_allclose(_positions(subset, stop - start), full[:, start:stop])
+
+
+def test_stream_remove_empty_traces(tmp_path):
+    from preprocess_mala import load_ramac, stream_remove_empty_traces
+
+    n_traces, n_samples = 100, 50
+    rng = np.random.default_rng(0)
+    rd3 = rng.integers(-1000, 1000, size=(n_traces, n_samples), dtype="<i2")
+    nonempty = np.arange(n_traces) % 10 != 3
+    rd3[~nonempty] = 0
+    rd3.tofile(tmp_path / "input.rd3")
+
+    rad = {"SAMPLES": str(n_samples), "LAST TRACE": str(n_traces)}
+    cor = pd.DataFrame({0: np.arange(1, n_traces + 1, 2), 1: "2025-04-20", 2: "10:00:00", 3: 79., 4: "N", 5: 24., 6: "E", 7: 500., 8: "M", 9: 1})
+    output_filepath = tmp_path / "output.rad"
+
+    # A small chunk size so that blocks boundaries are crossed
+    assert stream_remove_empty_traces(output_filepath, tmp_path / "input.rd3", rad, cor, chunk_size=16) == n_traces - nonempty.sum()
+
+    gpr = load_ramac(output_filepath)
+    np.testing.assert_array_equal(gpr.rd3, rd3[nonempty].T)
+    assert gpr.rad["LAST TRACE"] == str(nonempty.sum())
+    kept_traces = np.flatnonzero(nonempty) + 1
+    np.testing.assert_array_equal(kept_traces[gpr.cor[0] - 1] % 2, 1)
+
+
+def test_cor_cache_is_opt_in(tmp_path, monkeypatch):
+    from preprocess_mala import read_cor
+
+    cor_filepath = tmp_path / "line.cor"
+    pd.DataFrame({0: [1, 11], 1: "2025-04-20", 2: ["10:00:00", "10:00:01"], 3: 79., 4: "N", 5: 24., 6: "E", 7: 500., 8: "M", 9: 1}).to_csv(cor_filepath, sep="\t", header=False, index=False)
+    monkeypatch.chdir(tmp_path)
+
+    uncached = read_cor(cor_filepath)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["line.cor"]
+
+    cache_dir = tmp_path / "processed" / "cache" / "cor"
+    read_cor(cor_filepath, cache_dir=cache_dir)
+    assert len(list(cache_dir.iterdir())) == 1
+    pd.testing.assert_frame_equal(read_cor(cor_filepath, cache_dir=cache_dir), uncached, check_dtype=False)
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+
+from pulseekko import dt1_dtype, load_pulseekko, preprocess_pulseekko, read_gp2, write_gp2, write_hd
+
+
+def _write_line(hd_filepath, n_traces: int = 100, n_samples: int = 50, survey_mode: str = "Reflection") -> np.ndarray:
+    """Write a pulseEKKO line where every tenth trace is empty. Returns the mask of the nonempty traces."""
+    rng = np.random.default_rng(0)
+    write_hd(hd_filepath, {"1234": None, "NUMBER OF TRACES": str(n_traces), "NUMBER OF PTS/TRC": str(n_samples), "SURVEY MODE": survey_mode})
+
+    records = np.zeros(n_traces, dtype=dt1_dtype(n_samples))
+    records["header"][:, 0] = np.arange(1, n_traces + 1)
+    records["samples"] = rng.integers(-1000, 1000, size=(n_traces, n_samples))
+    nonempty = np.arange(n_traces) % 10 != 3
+    records["samples"][~nonempty] = 0
+    records.tofile(hd_filepath.with_suffix(".dt1"))
+
+    gp2 = pd.DataFrame({0: np.arange(1, n_traces + 1, 2), 1: "ok"})
+    gp2.attrs["preamble"] = ["traces,comment"]
+    write_gp2(hd_filepath.with_suffix(".gp2"), gp2)
+
+    return nonempty
+
+
+def test_preprocess_pulseekko_removes_empty_traces(tmp_path):
+    input_filepath = tmp_path / "input" / "line.hd"
+    input_filepath.parent.mkdir()
+    nonempty = _write_line(input_filepath)
+    output_filepath = tmp_path / "output" / "line.hd"
+
+    assert preprocess_pulseekko(output_filepath, input_filepath)
+
+    original = load_pulseekko(input_filepath)
+    gpr = load_pulseekko(output_filepath)
+    np.testing.assert_array_equal(gpr.rd3, original.rd3[:, nonempty])
+    np.testing.assert_array_equal(gpr.trace_headers[:, 0], np.arange(1, nonempty.sum() + 1))
+    assert gpr.rad["NUMBER OF TRACES"] == str(nonempty.sum())
+
+    # The GPS fixes of removed traces are dropped, and the others follow their traces
+    gp2 = read_gp2(output_filepath.with_suffix(".gp2"))
+    assert gp2.attrs["preamble"] == ["traces,comment"]
+    kept_traces = np.flatnonzero(nonempty) + 1
+    np.testing.assert_array_equal(kept_traces[gp2[0] - 1] % 2, 1)
+
+
+def test_preprocess_pulseekko_skips_gathers(tmp_path):
+    input_filepath = tmp_path / "cmp.hd"
+    _write_line(input_filepath, survey_mode="CMP")
+
+    # Removing the empty traces would shift the offsets of the following traces
+    assert not preprocess_pulseekko(tmp_path / "output" / "cmp.hd", input_filepath)
+    assert not (tmp_path / "output").exists()